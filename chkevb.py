@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+## Checks the topologies written by gmx4evb.py before they are given to grompp
+## use it as: chkevb.py -d topologies   (from the directory where gmx4evb.py was run)
+
+import sys, os, re, glob
+import argparse
+import time
+
+
+def get_args():
+    parser = argparse.ArgumentParser(epilog='''
+chkevb.py reads the topologies written by gmx4evb.py and checks that the atoms of all the terms exist, that no
+bonded term or pair is given twice, that [ pairs_nb ] are in [ exclusions ], that the soft-core tables exist and
+have the beta of their soft-core bonds, and that all the atom types (the dummy ones of evbless.top too) are
+defined. The first frame and evbless.top are checked line by line, while the other frames must be the same as
+the first one but for their [ pairs_nb ] entries, which are checked against those of the first frame.
+''')
+    parser.add_argument("-d", "--dir", help="directory with the topologies (default: topologies)", required=False, type=str, default='topologies')
+    args = parser.parse_args()
+
+    return args.dir
+
+# number of atoms in the lines of each directive
+directives = {'atoms': 1, 'bonds': 2, 'pairs': 2, 'pairs_nb': 2, 'angles': 3, 'dihedrals': 4, 'exclusions': 1}
+
+# the '; User:' and '; Date:' lines of the header may differ between frames written in different runs
+stamp_lines = re.compile(rb'^; (User|Date):.*\n', re.M)
+
+# [ pairs_nb ] entries, i.e. all the lines after '[ pairs_nb ]' that start with an atom index
+pairs_nb_block = re.compile(rb'(?:[ \t]*\d[^\n]*\n)*')
+
+errors = []
+
+def error(where, message):
+    errors.append(f'{where[0]}, line {where[1]}: {message}')
+
+# the lines of a topology, as (file, line number, line), with the .itp files written next to it by gmx4evb.py
+# (topol_head.itp, evbless_tail.itp, ...) in place of their #include; the other included files are returned apart
+def read_top(name):
+    lines, includes = [], []
+    with open(name) as f:
+        data = f.read().split("\n")
+    for i, line in enumerate(data):
+        l = line.split()
+        if (len(l) == 2) and (l[0] == '#include'):
+            inc = l[1].strip('"')
+            if os.path.isfile(os.path.join(os.path.dirname(name), inc)):
+                more, other = read_top(os.path.join(os.path.dirname(name), inc))
+                lines += more
+                includes += other
+            else:
+                includes.append((inc, os.path.dirname(name)))
+            continue
+        lines.append((os.path.basename(name), i+1, line))
+    return lines, includes
+
+# the atom types defined in the included files (force field, water, ions), following their #include in turn;
+# a file is looked for as grompp does, in the working directory, next to the file that includes it and in GMXLIB
+def read_atomtypes(includes):
+    atomtypes, missing, seen = set(), [], set()
+    while includes:
+        inc, where = includes.pop()
+        paths = [inc, os.path.join(where, inc)] + [os.path.join(p, inc) for p in os.environ.get('GMXLIB', '').split(':') if p]
+        found = [p for p in paths if os.path.isfile(p)]
+        if not found:
+            missing.append(inc)
+            continue
+        if os.path.abspath(found[0]) in seen:
+            continue
+        seen.add(os.path.abspath(found[0]))
+        directive = None
+        with open(found[0]) as f:
+            for line in f:
+                code = line.split(';')[0].strip()
+                if not code:
+                    continue
+                l = code.split()
+                if (l[0] == '#include') and (len(l) == 2):
+                    includes.append((l[1].strip('"'), os.path.dirname(found[0])))
+                elif code[0] == '[':
+                    directive = ''.join(l)[1:-1]
+                elif directive == 'atomtypes':
+                    atomtypes.add(l[0])
+    return atomtypes, missing
+
+# indexes the molecules of a topology: their atoms, bonded terms, pairs, exclusions and soft-core bonds
+# and checks each line while doing so
+def index_top(lines):
+    top = {'molecules': [], 'atomtypes': set(), 'evb': None}
+    mol = None
+    directive = None
+    for where, line in ((l[:2], l[2]) for l in lines):
+        if ("This section is dedicated to EVB atoms" in line) and mol:
+            mol['in_evb'] = True
+            top['evb'] = mol
+        code = line.split(';')[0].strip()
+        if (not code) or (code[0] == '#'):
+            continue
+        l = code.split()
+        if code[0] == '[':
+            directive = ''.join(l)[1:-1]
+            if directive == 'moleculetype':
+                mol = {'name': None, 'atoms': {}, 'terms': {}, 'system': set(), 'exclusions': set(), 'pairs_nb': {}, 'soft': [], 'in_evb': False}
+                top['molecules'].append(mol)
+            continue
+
+        if directive == 'atomtypes':
+            top['atomtypes'].add(l[0])
+            continue
+        elif (mol is None) or (directive in ['system', 'molecules']):
+            continue
+        elif directive == 'moleculetype':
+            mol['name'] = l[0]
+            continue
+        elif directive not in directives:
+            continue
+
+        n = directives[directive]
+        if len(l) < n + (directive != 'exclusions'):
+            error(where, f'[ {directive} ] line with too few fields')
+            continue
+        for at in (l if directive == 'exclusions' else l[:n]):
+            if (directive != 'atoms') and (at not in mol['atoms']):
+                error(where, f'atom {at} of [ {directive} ] is not in [ atoms ] of {mol["name"]}')
+
+        if directive == 'atoms':
+            if l[0] in mol['atoms']:
+                error(where, f'atom {l[0]} is given twice in [ atoms ]')
+            mol['atoms'][l[0]] = (l[1], l[8] if len(l) > 8 else l[1], where)
+            continue
+        elif directive == 'exclusions':
+            mol['exclusions'].update(frozenset((l[0], at)) for at in l[1:])
+            continue
+
+        # the parameters may be given by macros (e.g. improper_Z_N_X_Y), but not the function type nor the [ pairs_nb ] entries
+        try:
+            int(l[n])
+            [float(x) for x in l[n:]] if directive == 'pairs_nb' else None
+        except ValueError:
+            error(where, f'[ {directive} ] line with a field that is not a number')
+            continue
+
+        func = l[n]
+        key = frozenset(l[:n]) if n == 2 else min(tuple(l[:n]), tuple(l[n-1::-1]))
+        if directive == 'pairs_nb':
+            if key in mol['pairs_nb']:
+                error(where, f'[ pairs_nb ] {" ".join(l[:n])} is also at line {mol["pairs_nb"][key][1]} of {mol["pairs_nb"][key][0]}')
+            mol['pairs_nb'][key] = where
+            continue
+
+        # soft-core bonds are tabulated bonds of type 9, and bonds of type 10 are restraints, along the EVB bonds
+        term = (directive, key, func)
+        if (term in mol['terms']) and not ((directive == 'dihedrals') and (func == '9')):
+            error(where, f'[ {directive} ] {" ".join(l[:n])} of type {func} is also at line {mol["terms"][term][1]} of {mol["terms"][term][0]}')
+        mol['terms'][term] = where
+        if not mol['in_evb']:
+            mol['system'].add((directive, key))
+        elif ((directive, key) in mol['system']) and not ((directive == 'bonds') and (func in ['9', '10'])):
+            error(where, f'[ {directive} ] {" ".join(l[:n])} of the EVB section is also in the system topology (it should be commented out)')
+        if (directive == 'bonds') and (func == '9'):
+            beta = re.search(r'beta\s*=\s*(\S+)', line)
+            mol['soft'].append((l[3], l[5], float(beta.group(1)) if beta else None, where))
+    return top
+
+# the checks that need the whole molecule with the EVB atoms
+def check_evb(top, name, tables):
+    mol = top['evb']
+    if mol is None:
+        errors.append(f'{name}: the EVB section was not found')
+        return
+    for key, where in mol['pairs_nb'].items():
+        if key not in mol['exclusions']:
+            error(where, f'[ pairs_nb ] {" ".join(sorted(key))} is not in [ exclusions ]')
+
+    # table_b{i}.xvg is written by gmx4evb.py for the i-th beta of the soft-core bonds
+    betas = {}
+    for tA, tB, beta, where in mol['soft']:
+        for t in sorted({tA, tB}):
+            if t not in tables:
+                if t not in betas:
+                    error(where, f'table_b{t}.xvg of the soft-core bond was not found')
+            elif (beta is not None) and (tables[t] is not None) and (abs(tables[t] - beta) > 0.01):
+                error(where, f'table_b{t}.xvg is for beta = {tables[t]:.2f}, not {beta:.2f}')
+            if (beta is not None) and (betas.setdefault(t, beta) != beta):
+                error(where, f'the soft-core bonds with table {t} have different betas')
+
+# beta of each table_b{i}.xvg, from the ratio of its last two columns
+def read_tables(path):
+    tables = {}
+    for name in glob.glob(os.path.join(path, 'table_b*.xvg')):
+        t = os.path.basename(name)[len('table_b'):-len('.xvg')]
+        try:
+            with open(name) as f:
+                l = f.readline().split()
+            tables[t] = float(l[2])/float(l[1])
+        except:
+            tables[t] = None
+            errors.append(f'{name}: it could not be read')
+    return tables
+
+# atom types used in [ atoms ] but not defined anywhere
+def check_types(top, atomtypes):
+    for mol in top['molecules']:
+        for at, (tA, tB, where) in mol['atoms'].items():
+            for t in {tA, tB}:
+                if t not in atomtypes:
+                    error(where, f'the type {t} of atom {at} is not defined in [ atomtypes ]')
+
+def check_top(name, tables):
+    lines, includes = read_top(name)
+    top = index_top(lines)
+    check_evb(top, os.path.basename(name), tables)
+    return top, includes
+
+# a frame in three parts: up to the [ pairs_nb ] entries (without the header stamps), the entries and the rest,
+# and the line number of the first entry
+def split_frame(data):
+    start = data.find(b'\n[ pairs_nb ]\n')
+    if start < 0:
+        return None
+    start += len(b'\n[ pairs_nb ]\n')
+    end = pairs_nb_block.match(data, start).end()
+    header = min(start, 1024)
+    return stamp_lines.sub(b'', data[:header]) + data[header:start], data[start:end], data[end:], data.count(b'\n', 0, start) + 1
+
+# the [ pairs_nb ] entries of a frame must be those of the first frame, with other charges
+def check_block(name, line0, block, ref):
+    lines = block.decode().split("\n")[:-1]
+    if len(lines) != len(ref):
+        errors.append(f'{name}: {len(lines)} [ pairs_nb ] entries instead of {len(ref)}')
+        return
+    for i, (line, l0) in enumerate(zip(lines, ref)):
+        l = line.split(';')[0].split()
+        if (l[:3] != l0[:3]) or (len(l) != len(l0)):
+            error((name, line0+i), f'[ pairs_nb ] entry differs from the first frame ({" ".join(l0[:3])})')
+            continue
+        try:
+            [float(x) for x in l[3:]]
+        except ValueError:
+            error((name, line0+i), '[ pairs_nb ] line with a field that is not a number')
+
+
+if __name__ == "__main__":
+    path = get_args()
+    begin = time.time()
+
+    frames = sorted(glob.glob(os.path.join(path, 'topol_*.top')))
+    if not frames:
+        print(f'No topol_*.top files were found in {path}/')
+        sys.exit(1)
+    tables = read_tables(path)
+
+    # the first frame and evbless.top are checked line by line
+    top0, includes = check_top(frames[0], tables)
+    checked = [top0]
+    evbless = os.path.join(path, 'evbless.top')
+    if os.path.isfile(evbless):
+        top, more = check_top(evbless, tables)
+        checked.append(top)
+        includes += more
+        if top['evb'] and top0['evb'] and (set(top['evb']['atoms']) != set(top0['evb']['atoms'])):
+            errors.append(f'evbless.top: the atoms of {top["evb"]["name"]} are not those of {os.path.basename(frames[0])}')
+    else:
+        print(f'{evbless} was not found')
+
+    atomtypes, missing = read_atomtypes(includes)
+    atomtypes |= set(t for top in checked for t in top['atomtypes'])
+    if missing:
+        print(f'The atom types were not checked, since {", ".join(sorted(set(missing)))} could not be found')
+    else:
+        for top in checked:
+            check_types(top, atomtypes)
+
+    # the other frames differ from the first one only by [ pairs_nb ]
+    with open(frames[0], "rb") as f:
+        parts0 = split_frame(f.read())
+    if parts0 is None:
+        errors.append(f'{os.path.basename(frames[0])}: [ pairs_nb ] was not found')
+    else:
+        ref = [line.split(';')[0].split() for line in parts0[1].decode().split("\n")[:-1]]
+        for name in frames[1:]:
+            with open(name, "rb") as f:
+                parts = split_frame(f.read())
+            if (parts is None) or (parts[0] != parts0[0]) or (parts[2] != parts0[2]):
+                errors.append(f'{os.path.basename(name)}: it differs from {os.path.basename(frames[0])} outside [ pairs_nb ]')
+                continue
+            check_block(os.path.basename(name), parts[3], parts[1], ref)
+
+    for e in errors:
+        print(e)
+    print(f'{len(frames)} frames checked in {time.time()-begin:.2f} s: ' + (f'{len(errors)} errors found' if errors else 'no errors found'))
+    if errors:
+        sys.exit(1)
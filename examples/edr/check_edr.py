@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+## Checks the .edr reader of mapevb.py against gmx energy
+## use it as: python examples/edr/check_edr.py
+
+## small.edr was written by GROMACS 2021.5 (single precision, 4 frames) and small.xvg by gmx energy from it;
+## small_d.edr holds the header and the first 4 frames of a file written by GROMACS 5.0.7 in double precision,
+## and small_d.xvg the same frames from gmx energy -dp. They come from the test data of panedr/pyedr (LGPL-2.1,
+## see README and LICENSE-panedr.txt in this folder).
+
+import sys, os
+import tempfile
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', '..'))
+import mapevb
+
+# Potential, as printed by gmx energy
+known = {'small': [-525164.062500, -524592.125000, -524418.812500, -524649.062500],
+         'small_d': [857.560777191331, 1036.282059663014, 998.948689742142, 1051.823715474254]}
+# the xvg files have 6 decimals in single precision and 12 in double precision
+atol = {'small': 1e-6, 'small_d': 1e-9}
+
+failed = []
+
+def check(what, ok):
+    print(f"{'ok' if ok else 'FAILED':>6}  {what}")
+    if not ok:
+        failed.append(what)
+
+# True if func(*args) raises a ValueError that mentions text
+def raises(text, func, *args):
+    try:
+        func(*args)
+    except ValueError as err:
+        return text in str(err)
+    return False
+
+
+for name in ('small', 'small_d'):
+    edr, xvg = os.path.join(here, name + '.edr'), os.path.join(here, name + '.xvg')
+
+    # the potential is the default term, for both kinds of files
+    data = mapevb.read_edr(edr)
+    check(f'{name}.edr: Potential of the {len(known[name])} frames', (len(data) == len(known[name])) and np.allclose(data, known[name], rtol=0, atol=atol[name]))
+    check(f'{name}.xvg: Potential of the {len(known[name])} frames', np.allclose(mapevb.read_energy(xvg), known[name], rtol=0, atol=atol[name]))
+
+    # every term of the .xvg file, selected by name as with --term
+    with open(xvg) as f:
+        legends = mapevb.xvg_header(f)[0]
+    same = [term for term in legends if np.allclose(mapevb.read_energy(edr, term), mapevb.read_energy(xvg, term), rtol=1e-6, atol=atol[name])]
+    check(f'{name}.edr: the {len(legends)} terms are as in {name}.xvg', len(same) == len(legends))
+    check(f'{name}.edr: the term names are not case sensitive', np.array_equal(mapevb.read_energy(edr, 'potential'), data))
+
+    # a term that is not in the file
+    check(f'{name}.edr: a missing term is reported', raises("no 'Nope' term", mapevb.read_energy, edr, 'Nope'))
+    check(f'{name}.xvg: a missing term is reported', raises("no 'Nope' term", mapevb.read_energy, xvg, 'Nope'))
+
+    # a run that stopped while writing the last frame: that frame is left out, as gmx energy does
+    with open(edr, 'rb') as f:
+        buf = f.read()
+    with tempfile.TemporaryDirectory() as tmp:
+        cut = os.path.join(tmp, 'cut.edr')
+        with open(cut, 'wb') as f:
+            f.write(buf[:-10])
+        check(f'{name}.edr: a frame cut short is left out', np.array_equal(mapevb.read_edr(cut), data[:-1]))
+
+check('small.xvg is not taken for an .edr file', raises('not a GROMACS .edr file', mapevb.read_edr, os.path.join(here, 'small.xvg')))
+
+if failed:
+    sys.exit(f'{len(failed)} checks failed')
+print('All the checks passed')
@@ -15,8 +15,15 @@
 
 import sys, os 
 import copy
+import mmap
 import math as m
+import numpy as np
 import argparse
+import hashlib
+import re
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 def get_args():
@@ -26,7 +33,7 @@ RS and PS residue names should match the prefix from the ffld2gmx.py generated f
 the moieties in RS and PS states. More that one residue can be passed to each state. In case when more
 residues with the same name are present in the same state, they must be mentioned that many times.
 ''')
-    parser.add_argument("-f", "--frames", help="number of FEP windows", required=True, type=int)
+    parser.add_argument("-f", "--frames", help="number of FEP windows (not needed with --lambdas)", required=False, type=int, default=None)
     parser.add_argument("-q", "--qmatoms", help="QM atoms file constaining atom types, charges, soft-core repulsions\
                         and some other bonding parameters for the QM atoms (default: qmatoms.dat)", required=False, default="qmatoms.dat")
     parser.add_argument("-t", "--topology", help="Gromacs generated topology (default: topol.top)", required=False, default="topol.top")
@@ -34,6 +41,20 @@ residues with the same name are present in the same state, they must be mentione
     parser.add_argument("-p", "--products", nargs='*', help="list of product moieties", required=True, type=list)
     parser.add_argument("--cutoff", help="cut-off distance (default: 10 Å)", required=False, type=float, default=1.0)
     parser.add_argument("--precision", help="choose between 'single' or 'double' precision, depending on your GROMACS installation (default: single)", required=False, type=str, default='single')
+    parser.add_argument("-j", "--jobs", help="number of processes writing the topologies (default: 1)", required=False, type=int, default=1)
+    parser.add_argument("--shared", help="write the frame-invariant part of the topology only once (topol_head.itp and topol_tail.itp)\
+                        and keep only the [ pairs_nb ] entries in each topol_XXX.top", required=False, action='store_true')
+    parser.add_argument("--tables-cache", help="directory where the soft-core tables are kept and reused by other runs with the same beta, cutoff and precision",\
+                        required=False, default=None)
+    parser.add_argument("--lambdas", nargs='+', help="write only the frames of these lambdas (e.g. --lambdas 0.53), named topol_l<lambda>.top",
+                        required=False, type=float, default=None)
+    parser.add_argument("--sweep", help="file with the qmatoms.dat values to be changed; the topologies of every variant are written\
+                        in its own directory, in <sweep file>.d/ (see the comments above read_sweep() in gmx4evb.py)", required=False, default=None)
+    parser.add_argument("--stream", help="read topol.top and write the topologies chunk by chunk, without keeping the system in memory\
+                        (for very large systems; --jobs is not used)", required=False, action='store_true')
+    parser.add_argument("--force", help="rewrite all the files in topologies/, even if their inputs did not change", required=False, action='store_true')
+    parser.add_argument("--check-region2", help="list the atoms up to 3 bonds away from the EVB atoms that are missing from qmatoms.dat",
+                        required=False, action='store_true')
     args = parser.parse_args()
 
     rs , ps = [], []
@@ -42,25 +63,102 @@ residues with the same name are present in the same state, they must be mentione
     for i in args.products:
         ps.append(''.join(i))
 
-    return args.frames, args.qmatoms, args.topology, rs, ps, args.cutoff, args.precision
+    return args.frames, args.qmatoms, args.topology, rs, ps, args.cutoff, args.precision, args.shared, args.jobs, args.force, args.tables_cache, args.sweep, args.lambdas, args.stream, args.check_region2
 
 
-def filelist(state, top=''):
+# the .opls files of each residue of a state are the ones named after it in the directory of topol.top
+def filelist(state, top='topol.top'):
     files = {}
     for i in state:
         files[i] = []
     
-    flist = os.listdir()
+    folder = os.path.dirname(top)
+    flist = os.listdir(folder or '.')
     for f in flist:
         if '.opls' in f:
             for pre in state:
                 if f.startswith(pre):
-                    if not (f in files[pre]):
-                        files[pre].append(f)    
+                    if not (os.path.join(folder, f) in files[pre]):
+                        files[pre].append(os.path.join(folder, f))
+
+    for pre in state:
+        if not files[pre]:
+            raise ValueError(f"there are no {pre}*.opls files in {os.path.abspath(folder or '.')}")
 
     return files
 
-def read_qm(qm, rs, ps):
+# kinds of .opls files needed by the list builders, as they appear in the file names,
+# and the number of atom types that define a term of each kind
+opls_kinds = {'vdw': 1, 'bonds': 2, 'angles': 3, 'torsions': 4, 'impropers': 4}
+
+# reads every .opls file only once and keeps its lines split in columns
+def read_opls(files):
+    parsed = {}
+    for file in files:
+        rows = []
+        with open(file) as f:
+            data = f.read().strip().split("\n")
+        for line in data:
+            line = line.split()
+            if (not line) or (line[0] in ['#', ";", "!"]):
+                continue
+            rows.append(line)
+        parsed[file] = rows
+
+    return parsed
+
+# builds the parameter store of one state from the rows of each kind of .opls file, in the order of
+# the files of each residue. vdW parameters are indexed by atom type, {atom_type: (sigma, epsilon)},
+# with the first row of a type winning, and the bonded terms by their atom types, {(type1, type2, ...): [(file position, row), ...]},
+# keeping every row of the same atom types, as the list builders always had them
+# store['prefixes'][kind] keeps the leading types of the bonded terms, for find_terms()
+def opls_store(state, files, parsed):
+    store = {'prefixes': {}}
+    for kind, n in opls_kinds.items():
+        rows = []
+        seen = []
+        for i in state:
+            for j in files[i]:
+                if (kind in os.path.basename(j)) and (not (j in seen)):
+                    seen.append(j)
+                    rows += parsed[j]
+
+        if kind == 'vdw':
+            vdw = {}
+            for line in rows:
+                if not (line[0] in vdw):
+                    vdw[line[0]] = (line[6], line[7])
+            store['vdw'] = vdw
+            continue
+
+        terms = {}
+        prefixes = set()
+        for pos, line in enumerate(rows):
+            key = tuple(line[:n])
+            if not (key in terms):
+                terms[key] = []
+                for k in range(1, n):
+                    prefixes.add(key[:k])
+            terms[key].append((pos, line))
+        store[kind] = terms
+        store['prefixes'][kind] = prefixes
+
+    return store
+
+# rows of the store whose atom types are all in q, in the order of the .opls files
+# the type tuples are built one type at a time, keeping only those that start some term
+def find_terms(store, kind, q):
+    terms = store[kind]
+    prefixes = store['prefixes'][kind]
+    keys = [()]
+    for _ in range(opls_kinds[kind] - 1):
+        keys = [k + (at,) for k in keys for at in q if (k + (at,)) in prefixes]
+    found = [t for k in keys for at in q if (k + (at,)) in terms for t in terms[k + (at,)]]
+    found.sort(key=lambda t: t[0])
+    return [line for pos, line in found]
+
+# 'lines' can be given instead of reading the file qm (e.g. for the variants of a sweep)
+def read_qm(qm, rs, ps, lines=None):
     q1, q2 = [], []         # a list of atom-types
     du = {}                 # holds dummy atom {pdb_index: dummy_type, ...}
     soft_at = {}            # holds soft-core {pdb_index: (A, beta), ...}
@@ -80,8 +178,11 @@ def read_qm(qm, rs, ps):
     q2pdb(rs, qpdb, 'rs')
     q2pdb(ps, qpdb, 'ps')
        
-    with open(qm) as f:
-        data = f.read().split("\n")
+    if lines is None:
+        with open(qm) as f:
+            data = f.read().split("\n")
+    else:
+        data = lines
 
     for i,l in enumerate(data):
         if ';' in l:
@@ -135,7 +236,7 @@ def read_qm(qm, rs, ps):
                         if len(line) == 7:
                             du[line[0]] = line[5]
                         else:
-                            sys.exit()
+                            raise ValueError
 
                 elif sc:
                     soft_at[line[0]] = (float(line[1]), float(line[2])) # {'pdb_index': (A, beta)}
@@ -151,9 +252,8 @@ def read_qm(qm, rs, ps):
                     torevb.append(line)
                 elif imps:
                     impevb.append(line)
-        except:
-            print(f"\nTere is an error in {qm} file at line {i+1}.")
-            sys.exit()
+        except Exception as err:
+            raise ValueError(f"There is an error in {qm} file at line {i+1}.") from err
 
     return qpdb, q1, q2, du, charges, soft_at, bevb, bconstr, soft_pairs, aevb, torevb, impevb
 
@@ -178,85 +278,80 @@ def atom_list(charges, qpdb):
     
     return atoms
 
-def bonds_list(rs, ps, rs_files, ps_files, qpdb, q1, q2, bevb):
+# {pdb#: indexes of the terms in which it appears}, used to look only at the terms that share an atom
+def atom_index(terms, nested=True):
+    index = {}
+    for i, t in enumerate(terms):
+        for at in (t[0] if nested else t):
+            index.setdefault(at, []).append(i)
+    return index
+
+# the same angle or torsion can be listed from either end, so RS and PS terms are paired by
+# the direction in which their atoms compare lower
+def term_key(atoms):
+    atoms = tuple(atoms)
+    return min(atoms, atoms[::-1])
+
+def bonds_list(stores, qpdb, q1, q2, bevb):
     harmonic = 1
     
-    rsbf = []      # bond files for RS state
-    psbf = []      # bond files for PS state
-    rs_bonds = []  # bonds from rsbf files
-    ps_bonds = []  # bonds from psbf files
+    rs_bonds = []  # bonds from RS bond files
+    ps_bonds = []  # bonds from PS bond files
     bonds = []     # bonds in RS and PS paired by their pdb numbers
     bonds_x2y = [] # used for coulomb 1-2 and soft-core
 
-    def get_files(state, files, stbf):
-        for i in state:
-            for j in files[i]:
-                if 'bonds' in j:
-                    if not (j in stbf):
-                        stbf.append(j) # 'stbf': state_bond_file
-    
-    # 'stbf' is a state_bond_file
-    def get_bonds(files, st_qpdb, q, bonds):
-        for file in files:
-            with open(file) as f:
-                data = f.read().strip().split("\n")
-            for line in data:
-                line = line.split()
-                if line[0] in ['#', ";", "!"]:
-                    pass
-                elif (line[0] in q) and (line[1] in q):
-                    for ql in st_qpdb:
-                        if ((line[0] in ql.keys()) and (line[1] in ql.keys())) and (int(ql[line[0]][1]) == int(ql[line[1]][1]) == 1):
-                            bnd = [ql[line[0]][0], ql[line[1]][0], line[3], line[4]]
-                            if bnd in bonds:
-                                break
-                            else:
-                                bonds.append(bnd)
-            del(data)
+    def get_bonds(store, st_qpdb, q, bonds):
+        q = set(q)
+        seen = set()
+        for line in find_terms(store, 'bonds', q):
+            for ql in st_qpdb:
+                if ((line[0] in ql) and (line[1] in ql)) and (int(ql[line[0]][1]) == int(ql[line[1]][1]) == 1):
+                    bnd = [ql[line[0]][0], ql[line[1]][0], line[3], line[4]]
+                    if tuple(bnd) in seen:
+                        break
+                    else:
+                        seen.add(tuple(bnd))
+                        bonds.append(bnd)
     
     # check if a bond is present only in rs or only in ps
     # here I used 5 whenever > 2 (i.e., more than one bond away)
+    # the bonds are paired by their atoms, in whatever direction they are listed
     def check_bonds(bonds, bonds_x2y, rs_bonds, ps_bonds):
+        ps_keys = {}
+        for l2 in ps_bonds:
+            ps_keys.setdefault(frozenset(l2[:2]), l2)
+        rs_keys = {frozenset(l1[:2]) for l1 in rs_bonds}
+
         for l1 in rs_bonds:
-            chk = True
-            for l2 in ps_bonds:
-                if (l1[0] in l2[:2]) and (l1[1] in l2[:2]):
-                    bonds.append([l1[0], l1[1], harmonic, l1[2], l1[3], l2[2], l2[3]])
-                    chk = False
-                    break
-            if chk:
+            l2 = ps_keys.get(frozenset(l1[:2]))
+            if l2:
+                bonds.append([l1[0], l1[1], harmonic, l1[2], l1[3], l2[2], l2[3]])
+            else:
                 #bonds.append([l1[0], l1[1], morse, '<b0>', '<D>', '<beta>', '<b0>', 0.0, 0.0])
                 bonds.append([l1[0], l1[1], harmonic, l1[2], l1[3], 0.0, 0.0])
                 bonds_x2y.append((l1[:2], 25))
     
         # check if a bond is present only in ps
         for l2 in ps_bonds:
-            chk = True
-            for l1 in rs_bonds:
-                if (l2[0] in l1[:2]) and (l2[1] in l1[:2]):
-                    chk = False
-                    break
-            if chk:
+            if not (frozenset(l2[:2]) in rs_keys):
                 #bonds.append([l2[0], l2[1], morse, '<b0>', 0.0, 0.0, '<b0>', '<D>', '<beta>'])
                 bonds.append([l2[0], l2[1], harmonic, 0.0, 0.0, l2[2], l2[3]])
                 bonds_x2y.append((l2[:2], 52))
     
     def substitute_bevb(bonds, bevb):
+        index = {}
+        for i, b in enumerate(bonds):
+            index.setdefault(frozenset(b[:2]), i)
         for m in bevb:
-            chk = True
-            for i, b in enumerate(bonds):
-                if (m[0] in b[:2]) and (m[1] in b[:2]):
-                    chk = False
-                    bonds[i] = m
-                    break
-            if chk:
+            key = frozenset(m[:2])
+            if key in index:
+                bonds[index[key]] = m
+            else:
+                index[key] = len(bonds)
                 bonds.append(m)
             
-    get_files(rs, rs_files, rsbf)
-    get_files(ps, ps_files, psbf)            
-            
-    get_bonds(rsbf, qpdb['rs'], q1, rs_bonds)
-    get_bonds(psbf, qpdb['ps'], q2, ps_bonds)
+    get_bonds(stores['rs'], qpdb['rs'], q1, rs_bonds)
+    get_bonds(stores['ps'], qpdb['ps'], q2, ps_bonds)
     
     check_bonds(bonds, bonds_x2y, rs_bonds, ps_bonds)
     
@@ -267,82 +362,63 @@ def bonds_list(rs, ps, rs_files, ps_files, qpdb, q1, q2, bevb):
 
 ### atoms in forming/breaking angles must all be in region 1
 ### because they contribute to EVB bonding energy
-def angles_list(rs, ps, rs_files, ps_files, qpdb, q1, q2, aevb):
+def angles_list(stores, qpdb, q1, q2, aevb):
     func = 1
     
-    rsaf = []       # anlge files for RS state
-    psaf = []       # angle files for PS state
-    rs_angles = []  # angles from rsaf files
-    ps_angles = []  # angles from psaf files
+    rs_angles = []  # angles from RS angle files
+    ps_angles = []  # angles from PS angle files
     angles = []     # angles in RS and PS paired by their pdb numbers
     angles_x2y = [] # used for coulomb 1-2 and soft-core
 
-    def get_files(state, files, staf):
-        for i in state:
-            for j in files[i]:
-                if 'angles' in j:
-                    if not (j in staf):
-                        staf.append(j) # 'staf': state_angle_file
-    
-    def get_angles(files, st_qpdb, q, angles):
-        for file in files:
-            with open(file) as f:
-                data = f.read().strip().split("\n")
-            for line in data: 
-                line = line.split()
-                if line[0] in ['#', ";", "!"]:
-                    pass
-                elif (line[0] in q) and (line[1] in q) and (line[2] in q):
-                    for ql in st_qpdb:
-                        if ((line[0] in ql.keys()) and (line[1] in ql.keys()) and (line[2] in ql.keys())) and ((int(ql[line[0]][1]) == int(ql[line[1]][1]) == int(ql[line[2]][1]) == 1)):
-                            ang = [ql[line[0]][0], ql[line[1]][0], ql[line[2]][0], line[4], line[5]]
-                            if ang in angles:
-                                break
-                            else:
-                                angles.append(ang)           
-            del(data)
+    def get_angles(store, st_qpdb, q, angles):
+        q = set(q)
+        seen = set()
+        for line in find_terms(store, 'angles', q):
+            for ql in st_qpdb:
+                if ((line[0] in ql) and (line[1] in ql) and (line[2] in ql)) and ((int(ql[line[0]][1]) == int(ql[line[1]][1]) == int(ql[line[2]][1]) == 1)):
+                    ang = [ql[line[0]][0], ql[line[1]][0], ql[line[2]][0], line[4], line[5]]
+                    if tuple(ang) in seen:
+                        break
+                    else:
+                        seen.add(tuple(ang))
+                        angles.append(ang)
     
     def check_angles(angles, angles_x2y, rs_angles, ps_angles):
         # check if angles only in rs
         # here I used 5 whenever it is not 3 (i.e., 2 bonds away)
+        ps_keys = {}
+        for l2 in ps_angles:
+            ps_keys.setdefault(term_key(l2[:3]), l2)
+        rs_keys = {term_key(l1[:3]) for l1 in rs_angles}
+
         for l1 in rs_angles:
-            chk = True
-            for l2 in ps_angles:
-                if (l1[:3] == l2[:3]) or (l1[:3] == l2[:3][::-1]):
-                    angles.append([l1[0], l1[1], l1[2], func, l1[3], l1[4], l2[3], l2[4]])
-                    chk = False
-                    break
-            if chk:
+            l2 = ps_keys.get(term_key(l1[:3]))
+            if l2:
+                angles.append([l1[0], l1[1], l1[2], func, l1[3], l1[4], l2[3], l2[4]])
+            else:
                 angles.append([l1[0], l1[1], l1[2], func, l1[3], l1[4], 0.0, 0.0])
                 angles_x2y.append((l1[:3], 35))
     
         # check if angles only in ps
         for l2 in ps_angles:
-            chk = True
-            for l1 in rs_angles:
-                if (l2[:3] == l1[:3]) or (l2[:3] == l1[:3][::-1]):
-                    chk = False
-                    break
-            if chk:
+            if not (term_key(l2[:3]) in rs_keys):
                 angles.append([l2[0], l2[1], l2[2], func, 0.0, 0.0, l2[3], l2[4]])
                 angles_x2y.append((l2[:3], 53))
 
     def substitute_aevb(angles, aevb):
+        index = {}
+        for i, a in enumerate(angles):
+            index.setdefault(frozenset(a[:3]), i)
         for ang in aevb:
-            chk = True
-            for i, a in enumerate(angles):
-                if (ang[0] in a[:3]) and (ang[1] in a[:3]) and (ang[2] in a[:3]):
-                    chk = False
-                    angles[i] = ang
-                    break
-            if chk:
+            key = frozenset(ang[:3])
+            if key in index:
+                angles[index[key]] = ang
+            else:
+                index[key] = len(angles)
                 angles.append(ang)
                 
-    get_files(rs, rs_files, rsaf)
-    get_files(ps, ps_files, psaf)
-                
-    get_angles(rsaf, qpdb['rs'], q1, rs_angles)
-    get_angles(psaf, qpdb['ps'], q2, ps_angles)
+    get_angles(stores['rs'], qpdb['rs'], q1, rs_angles)
+    get_angles(stores['ps'], qpdb['ps'], q2, ps_angles)
     
     check_angles(angles, angles_x2y, rs_angles, ps_angles)
     
@@ -351,37 +427,24 @@ def angles_list(rs, ps, rs_files, ps_files, qpdb, q1, q2, aevb):
     
     return angles, angles_x2y
 
-def torsions_list(param, rs, ps, rs_files, ps_files, qpdb, q1, q2, torevb):
-    rstf = []         # torsion files for RS state
-    pstf = []         # torsion files for PS state
-    rs_torsions = []  # torsions from rstf files
-    ps_torsions = []  # torsions from pstf files
+def torsions_list(param, stores, qpdb, q1, q2, torevb):
+    rs_torsions = []  # torsions from RS torsion files
+    ps_torsions = []  # torsions from PS torsion files
     torsions = []     # torsions in RS and PS paired by their pdb numbers
 
-    def get_files(state, files, sttf, param):
-        for i in state:
-            for j in files[i]:
-                if param in j:
-                    if not (j in sttf):
-                        sttf.append(j) # 'sttf': state_torsion_file    
-    
-    def get_tor(files, st_qpdb, q, torsions):
-        for file in files:
-            with open(file) as f:
-                data = f.read().strip().split("\n")
-            for line in data:
-                line = line.split()
-                if line[0] in ['#', ";", "!"]:
-                    pass
-                elif (line[0] in q) and (line[1] in q) and (line[2] in q) and (line[3] in q):
-                    for ql in st_qpdb:
-                        if ((line[0] in ql.keys()) and (line[1] in ql.keys()) and line[2] in ql.keys() and line[3] in ql.keys()) and (int(ql[line[0]][1])+int(ql[line[1]][1])+int(ql[line[2]][1])+int(ql[line[3]][1])<=5):
-                            tor = [ql[line[0]][0], ql[line[1]][0], ql[line[2]][0], ql[line[3]][0], line[4], line[5:]]
-                            if tor in torsions:
-                                break
-                            else:
-                                torsions.append(tor)
-            del(data)        
+    def get_tor(store, st_qpdb, q, torsions):
+        q = set(q)
+        seen = set()
+        for line in find_terms(store, param, q):
+            for ql in st_qpdb:
+                if ((line[0] in ql) and (line[1] in ql) and line[2] in ql and line[3] in ql) and (int(ql[line[0]][1])+int(ql[line[1]][1])+int(ql[line[2]][1])+int(ql[line[3]][1])<=5):
+                    tor = [ql[line[0]][0], ql[line[1]][0], ql[line[2]][0], ql[line[3]][0], line[4], line[5:]]
+                    key = tuple(tor[:5]) + tuple(tor[5])
+                    if key in seen:
+                        break
+                    else:
+                        seen.add(key)
+                        torsions.append(tor)
     
     
     def check_tor(torsions, rs_torsions, ps_torsions):
@@ -392,65 +455,52 @@ def torsions_list(param, rs, ps, rs_files, ps_files, qpdb, q1, q2, torevb):
         else:
             func = 0
         
+        ps_keys = {}
+        for l2 in ps_torsions:
+            ps_keys.setdefault(term_key(l2[:4]), l2)
+        rs_keys = {term_key(l1[:4]) for l1 in rs_torsions}
+
         # if proper torsion
         if func == 3:
             for l1 in rs_torsions:
-                chk = True
-                for l2 in ps_torsions:
-                    if (l1[:4] == l2[:4]) or (l1[:4] == l2[:4][::-1]):
-                        torsions.append([l1[0], l1[1], l1[2], l1[3], func, l1[5][0], l1[5][1], l1[5][2], l1[5][3], l1[5][4], l1[5][5], l2[5][0], l2[5][1], l2[5][2], l2[5][3], l2[5][4], l2[5][5]])
-                        chk = False
-                        break
-                if chk:
+                l2 = ps_keys.get(term_key(l1[:4]))
+                if l2:
+                    torsions.append([l1[0], l1[1], l1[2], l1[3], func, l1[5][0], l1[5][1], l1[5][2], l1[5][3], l1[5][4], l1[5][5], l2[5][0], l2[5][1], l2[5][2], l2[5][3], l2[5][4], l2[5][5]])
+                else:
                     torsions.append([l1[0], l1[1], l1[2], l1[3], func, l1[5][0], l1[5][1], l1[5][2], l1[5][3], l1[5][4], l1[5][5], 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]) 
                         
             for l2 in ps_torsions:
-                chk = True
-                for l1 in rs_torsions:
-                    if (l2[:4] == l1[:4]) or (l2[:4] == l1[:4][::-1]):
-                        chk = False
-                        break
-                if chk:
+                if not (term_key(l2[:4]) in rs_keys):
                     torsions.append([l2[0], l2[1], l2[2], l2[3], func, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, l2[5][0], l2[5][1], l2[5][2], l2[5][3], l2[5][4], l2[5][5]])
 
         # if improper torsion
         elif func == 2:
             for l1 in rs_torsions:
-                chk = True
-                for l2 in ps_torsions:
-                    if (l1[:4] == l2[:4]) or (l1[:4] == l2[:4][::-1]):
-                        torsions.append([l1[0], l1[1], l1[2], l1[3], func, l1[5][0], l1[5][1], l2[5][0], l2[5][1]])
-                        chk = False
-                        break
-                if chk:
+                l2 = ps_keys.get(term_key(l1[:4]))
+                if l2:
+                    torsions.append([l1[0], l1[1], l1[2], l1[3], func, l1[5][0], l1[5][1], l2[5][0], l2[5][1]])
+                else:
                     torsions.append([l1[0], l1[1], l1[2], l1[3], func, l1[5][0], l1[5][1], l1[5][0], 0.0])
                         
             for l2 in ps_torsions:
-                chk = True
-                for l1 in rs_torsions:
-                    if (l2[:4] == l1[:4]) or (l2[:4] == l1[:4][::-1]):
-                        chk = False
-                        break
-                if chk:
+                if not (term_key(l2[:4]) in rs_keys):
                     torsions.append([l2[0], l2[1], l2[2], l2[3], func, l2[5][0], 0.0, l2[5][0], l2[5][1]])
                     #torsions_x2y.append([l2[0], l2[1], l2[2], l2[3], func, l2[4], 0.0, l2[4], l2[5]])
                     
     def substitute_torevb(torsions, torevb):
+        index = {}
+        for i, t in enumerate(torsions):
+            index.setdefault(frozenset(t[:4]), i)
         for tor in torevb:
-            chk = True
-            for i, t in enumerate(torsions):
-                if (tor[0] in t[:4]) and (tor[1] in t[:4]) and (tor[2] in t[:4]) and (tor[3] in t[:4]):
-                    chk = False
-                    torsions[i] = tor
-                    break
-            if chk:
-                torsions.append(tor)            
+            key = frozenset(tor[:4])
+            if key in index:
+                torsions[index[key]] = tor
+            else:
+                index[key] = len(torsions)
+                torsions.append(tor)
     
-    get_files(rs, rs_files, rstf, param)
-    get_files(ps, ps_files, pstf, param)
-        
-    get_tor(rstf, qpdb['rs'], q1, rs_torsions)
-    get_tor(pstf, qpdb['ps'], q2, ps_torsions)
+    get_tor(stores['rs'], qpdb['rs'], q1, rs_torsions)
+    get_tor(stores['ps'], qpdb['ps'], q2, ps_torsions)
 
     check_tor(torsions, rs_torsions, ps_torsions)
     
@@ -468,184 +518,99 @@ def torsions_list(param, rs, ps, rs_files, ps_files, qpdb, q1, q2, torevb):
 #   *--*      *-*
 #  /     ->  /\/
 # *--*      *-*
-def pairs_list(rs, ps, rs_files, ps_files, qpdb, q1, q2):
-    # lists of vdw, bonds, and angle files in RS and PS states
-    rsvdwf = []    # vdw files in rs
-    rsbf = []      # bonds files in rs
-    rsaf = []      # angles files in rs
-    psvdwf = []
-    psbf = []
-    psaf = []
+def pairs_list(stores, qpdb, q1, q2):
     pairs_x2y = [] # this gets returned
     
-    # get_files(state, state_file, state_vdw, state_bond, state_angle)
-    def get_files(state, files, xvdwf, xbf, xaf):
-        for i in state:
-            for j in files[i]:
-                if 'vdw' in j:
-                    if not (j in xvdwf):
-                        xvdwf.append(j)
-                elif 'bonds' in j:
-                    if not (j in xbf):
-                        xbf.append(j)
-                elif 'angles' in j:
-                    if not (j in xaf):
-                        xaf.append(j)
-    
-    def get_vdws(files, st_qpdb, q):
+    def get_vdws(store, st_qpdb, q):
         vdw={}
-        for file in files:
-            with open(file) as f:
-                data = f.read().strip().split("\n")
-            for line in data:
-                line = line.split()
-                if line[0] in ['#', ";", "!"]:
-                    pass
-                elif line[0] in q:
-                    for ql in st_qpdb:
-                        if line[0] in ql.keys():
-                            if ql[line[0]][0] in vdw.keys():
-                                break
-                            else:
-                                # {pdb#: (sigma, epsilon)}
-                                vdw[ql[line[0]][0]] = (line[6], line[7])
-            del(data)  # needed in jupyter-notebook
+        q = set(q)
+        for ql in st_qpdb:
+            for at in ql:
+                if (at in q) and (at in store['vdw']) and (not (ql[at][0] in vdw)):
+                    # {pdb#: (sigma, epsilon)}
+                    vdw[ql[at][0]] = store['vdw'][at]
         return vdw
     
     # gets also bonds between q and non-q atoms
     # that's why I don't keep the bonds from bonds_list()
-    def get_bonds(files, st_qpdb, q):
+    def get_bonds(store, st_qpdb, q):
         bonds = []
-        for file in files:
-            with open(file) as f:
-                data = f.read().strip().split("\n")
-            for line in data:
-                line = line.split()
-                if line[0] in ['#', ";", "!"]:
-                    pass
-                elif (line[0] in q) and (line[1] in q):
-                    # st_qpdb is a list of dictionaries
-                    for ql in st_qpdb:
-                        if (line[0] in ql.keys()) and (line[1] in ql.keys()):
-                            bond = (ql[line[0]][0], ql[line[1]][0])
-                            if bond in bonds:
-                                break
-                            else:
-                                bonds.append(bond)
-            del(data)  # needed in jupyter-notebook
+        q = set(q)
+        seen = set()
+        for line in find_terms(store, 'bonds', q):
+            # st_qpdb is a list of dictionaries
+            for ql in st_qpdb:
+                if (line[0] in ql) and (line[1] in ql):
+                    bond = (ql[line[0]][0], ql[line[1]][0])
+                    if bond in seen:
+                        break
+                    else:
+                        seen.add(bond)
+                        bonds.append(bond)
         return bonds
     
-    def get_angles(files, st_qpdb, q):
+    def get_angles(store, st_qpdb, q):
         angles = []
-        for file in files:
-            with open(file) as f:
-                data = f.read().strip().split("\n")
-            for line in data:
-                line = line.split()
-                if line[0] in ['#', ";", "!"]:
-                    pass
-                elif (line[0] in q) and (line[1] in q) and (line[2] in q):
-                    for ql in st_qpdb:
-                        if (line[0] in ql.keys()) and (line[1] in ql.keys()) and (line[2] in ql.keys()):
-                            ang = (ql[line[0]][0], ql[line[1]][0], ql[line[2]][0])
-                            if ang in angles:
-                                break
-                            else:
-                                angles.append(ang)
-            del(data)  # needed in jupyter-notebook
+        q = set(q)
+        seen = set()
+        for line in find_terms(store, 'angles', q):
+            for ql in st_qpdb:
+                if (line[0] in ql) and (line[1] in ql) and (line[2] in ql):
+                    ang = (ql[line[0]][0], ql[line[1]][0], ql[line[2]][0])
+                    if ang in seen:
+                        break
+                    else:
+                        seen.add(ang)
+                        angles.append(ang)
         return angles
     
-    # gives indexes for 1-4 pairs
-    def get_indexes(bonds):
-        indexes = []  # atom indexes for 1-4 pairs
-        for i, l1 in enumerate(bonds[:-2]):
-            at1, at2 = l1[:2]
-            for j, l2 in enumerate(bonds[i+1:]):
-                at3 = None
-                if at2 == l2[0]:
-                    at3 = l2[1]
-                elif at2 == l2[1]:
-                    at3 = l2[0]
-                elif at1 == l2[0]:
-                    at1 = at2
-                    at2 = l2[0]
-                    at3 = l2[1]
-                elif at1 == l2[1]:
-                    at1 = at2
-                    at2 = l2[1]
-                    at3 = l2[0]
-                if at3:
-                    # starts from 'i+1' because the bonds may not be listed in order
-                    for l3 in bonds[i+1:]:
-                        at4 = at0 = None
-                        if l3 == l2:
-                            continue
-                        if at3 == l3[0]:
-                            at4 = l3[1]
-                        elif at3 == l3[1]:
-                            at4 = l3[0]
-                        elif at1 == l3[0]:
-                            at0 = l3[1]
-                        elif at1 == l3[1]:
-                            at0 = l3[0]
-                        if at4:
-                            indexes.append((at1, at4))
-                        elif at0:
-                            indexes.append((at0, at3))
-        return indexes
-
-    # remove pairs that form closed loops (or 3 atoms ring, like in epoxy) - see 1st pictogram
-    # iterates for every epoxyde (just in case there is more than one epoxyde)
-    # NOTE: when you remove an element of a list, it shifts with respect to 'enumerate' 
-    def chk_3loop(indexes):
-        chk = True
-        while chk:
-            for i, j in enumerate(indexes):
-                if j[0] == j[1]:
-                    indexes.pop(i)
-                    break
-            chk = False        
-    
-    # remove redundancies
-    def redund(indxs):
-        nored = []
-        for p in indxs:
-            if (p in nored) or (p[::-1] in nored):
-                pass
-            else:
-                nored.append(p)
+    # bond adjacency graph {pdb#: [(bonded pdb#, bond index), ...]}, in the order of the bonds
+    def get_graph(bonds):
+        graph = {}
+        for i, (at1, at2) in enumerate(bonds):
+            graph.setdefault(at1, []).append((at2, i))
+            graph.setdefault(at2, []).append((at1, i))
+        return graph
+
+    # gives the 1-4 pairs with a breadth first search of 3 bonds from every atom
+    # an atom is 1-4 only if there is no shorter path to it, so pairs closing 3, 4 or 5 atoms rings
+    # (e.g. epoxydes, see 1st pictogram) are left out, as well as the pairs that are also found in angles
+    # the pairs are sorted and oriented by the order of the bonds along their path, as they were with the old bond scan
+    def get_indexes(graph, angles):
+        near = set()
+        for a in angles:
+            near.update((frozenset((a[0], a[1])), frozenset((a[1], a[2])), frozenset((a[0], a[2]))))
+
+        found = {}
+        for at in graph:
+            # {pdb#: indexes of the bonds on the path from at}
+            paths = {at: ()}
+            shell = [at]
+            for _ in range(3):
+                bonded = []
+                for i in shell:
+                    for j, b in graph[i]:
+                        if not (j in paths):
+                            paths[j] = paths[i] + (b,)
+                            bonded.append(j)
+                shell = bonded
+            for j in shell:
+                pair = frozenset((at, j))
+                if not ((pair in found) or (pair in near)):
+                    b1, b2, b3 = paths[j]
+                    if b2 < min(b1, b3):
+                        # the middle bond comes first, then the end bonds in their order
+                        found[pair] = ((b2, min(b1, b3), max(b1, b3)), (j, at) if b1 < b3 else (at, j))
+                    else:
+                        # the first end bond, then the middle one and the other end
+                        found[pair] = ((min(b1, b3), b2, max(b1, b3)), (at, j) if b1 < b3 else (j, at))
+
+        return [p for key, p in sorted(found.values())]
 
-        return nored
-    
-    # remove pairs that may also form bonds or angles in 4 or 5 atoms rings
-    def purify(nored, angles):
-        # checks if pair exists in rs_angles or ps_angles      
-        # checking for angles already involves checking over bonds
-        pure = []
-        for p in nored:
-            chk = True
-            for a in angles:
-                if (p[0] in a) and (p[1] in a):
-                    chk = False
-                    break
-            if chk:
-                pure.append(p)
-                    
-        return pure
-    
     # keep pairs that belong only to one of the reactant states
     def sift(a, b):
-        holder = []
-        for p1 in a:
-            chk = True
-            for p2 in b:
-                if (p1[0] in p2) and (p1[1] in p2):
-                    chk = False
-                    break
-            if chk:
-                holder.append(p1)
-                
-        return holder
+        b = {frozenset(p) for p in b}
+        return [p for p in a if not (frozenset(p) in b)]
 
     # assign labels to pairs that belong only to one state
     def classify(pairs_x2y, pairs, bonds, angles, state):
@@ -653,59 +618,33 @@ def pairs_list(rs, ps, rs_files, ps_files, qpdb, q1, q2):
             labels = (42, 43, 45)
         elif state == "ps":
             labels = (24, 34, 54)
+        # here you must also check the bonds, in case there is a double bond breaking that results in a 2 atoms moiety
+        bonded = {frozenset(b) for b in bonds}
+        angled = {frozenset((a[0], a[2])) for a in angles}
         for p in pairs:
-            # here you must also check the pairs, in case there is a double bond breaking that results in a 2 atoms moiety
-            chk_b = False # checks if pair is present in bonds
-            chk_a = False # checks if pair is present in angles
-            
-            for b in bonds:
-                if (p[0] in b) and (p[1] in b):
-                    chk_b = True
-                    break
-            for a in angles:
-                if (a[0] in p) and (a[2] in p):
-                    chk_a = True
-                    break 
-            
             # e.g. 42 = pair (i.e. 1-4) in RS and bond (i.e. 1-2) in PS
-            if chk_b:
+            if frozenset(p) in bonded:
                 pairs_x2y.append((p, labels[0]))
-            elif chk_a:
+            elif frozenset(p) in angled:
                 pairs_x2y.append((p, labels[1]))
             else:
                 pairs_x2y.append((p, labels[2]))
     
-    # get lists of files containing vdw, bonds, angles and proper dihedrals
-    get_files(rs, rs_files, rsvdwf, rsbf, rsaf)
-    get_files(ps, ps_files, psvdwf, psbf, psaf)
-    
     # saves all vdw in RS and PS
-    rs_vdw = get_vdws(rsvdwf, qpdb['rs'], q1)
-    ps_vdw = get_vdws(psvdwf, qpdb['ps'], q2)
+    rs_vdw = get_vdws(stores['rs'], qpdb['rs'], q1)
+    ps_vdw = get_vdws(stores['ps'], qpdb['ps'], q2)
     
     # don't use bonds and angles from bond_list() or angle_list() because they don't have region 2 atoms
-    rs_bonds = get_bonds(rsbf, qpdb['rs'], q1)
-    ps_bonds = get_bonds(psbf, qpdb['ps'], q2)
+    rs_bonds = get_bonds(stores['rs'], qpdb['rs'], q1)
+    ps_bonds = get_bonds(stores['ps'], qpdb['ps'], q2)
     
     # saves all angles in RS and PS
-    rs_angles = get_angles(rsaf, qpdb['rs'], q1)
-    ps_angles = get_angles(psaf, qpdb['ps'], q2)
-    
-    # get indexes for 1-4 pairs in RS and PS
-    rs_indexes = get_indexes(rs_bonds)
-    ps_indexes = get_indexes(ps_bonds)
-    
-    # remove pairs from 3 atoms rings
-    chk_3loop(rs_indexes)
-    chk_3loop(ps_indexes)
+    rs_angles = get_angles(stores['rs'], qpdb['rs'], q1)
+    ps_angles = get_angles(stores['ps'], qpdb['ps'], q2)
     
-    # remove redundant pairs
-    rs_nored = redund(rs_indexes)
-    ps_nored = redund(ps_indexes)
-    
-    # do this before checking for RS vs. PS
-    rs_pure = purify(rs_nored, rs_angles)
-    ps_pure = purify(ps_nored, ps_angles)
+    # get 1-4 pairs in RS and PS, without ring closures and redundancies
+    rs_pure = get_indexes(get_graph(rs_bonds), rs_angles)
+    ps_pure = get_indexes(get_graph(ps_bonds), ps_angles)
     
     # get pairs that belong only to one of the states
     rs_only = sift(rs_pure, ps_pure)
@@ -730,70 +669,66 @@ def coulomb_list(bonds_x2y, angles_x2y, pairs_x2y, bonds, angles):
     at_ad = []     # list of donor-acceptor atoms
     
     # Delets 24, 34, 42 and 43 from bonds_x2y and angles_x2y
-    # which are already given in pairs_x2y
+    # which are already given in pairs_x2y; every pair deletes only the first bond and angle it matches
+    counts = {}
     for p in pairs_x2y:
-        for i, b in enumerate(bonds_solo):
-            if (p[0][0] in b[0]) and (p[0][1] in b[0]):
-                bonds_solo.pop(i)
-                break        
-        for j, a in enumerate(angles_solo):
-            if (a[0][0] in p[0]) and (a[0][2] in p[0]):
-                angles_solo.pop(j)
-                break 
+        key = frozenset(p[0])
+        counts[key] = counts.get(key, 0) + 1
+
+    def drop_pairs(terms, key):
+        left = dict(counts)
+        kept = []
+        for t in terms:
+            k = key(t)
+            if left.get(k, 0):
+                left[k] -= 1
+            else:
+                kept.append(t)
+        return kept
+
+    bonds_solo = drop_pairs(bonds_solo, lambda b: frozenset(b[0]))
+    angles_solo = drop_pairs(angles_solo, lambda a: frozenset((a[0][0], a[0][2])))
 
     # checks if 25 and 52 are not actually 23 and 32
-    chk = True
-    while chk:
-        chk = False
-        for i, b in enumerate(bonds_solo):
-            for a in angles:
-                if (a[0] in b[0]) and (a[2] in b[0]):
-                    if b[1] == 25 and a[7]:
-                        bonds_solo.pop(i)
-                        chk = True
-                        break
-                    elif b[1] == 52 and a[5]:
-                        bonds_solo.pop(i)
-                        chk = True
-                        break
-            if chk:
-                break
+    ends = {}
+    for a in angles:
+        ends.setdefault(frozenset((a[0], a[2])), []).append(a)
+
+    def bond_23(b):
+        for a in ends.get(frozenset(b[0]), []):
+            if (b[1] == 25 and a[7]) or (b[1] == 52 and a[5]):
+                return True
+        return False
+
+    bonds_solo = [b for b in bonds_solo if not bond_23(b)]
 
     # checks if 35 and 53 are not actually 32 and 23
-    chk = True
-    while chk:
-        chk = False
-        for i, a in enumerate(angles_solo):
-            for b in bonds:
-                if (a[0][0] in b[:2]) and (a[0][2] in b[:2]):
-                    if b[2] == 3: # if Morse, the list is larger then if it is harmonic
-                        if a[1] == 35 and b[7]:    # b[7] checks for k_Morse(PS)
-                            angles_solo.pop(i)
-                            chk = True
-                            break
-                        elif a[1] == 53 and b[4]:  # b[4] checks for k_Morse(RS)
-                            angles_solo.pop(i)
-                            chk = True
-                            break
-                    elif b[2] == 1: # if harmonic
-                        if a[1] == 35 and b[6]:    # b[6] checks for k_harmonic(PS)
-                            angles_solo.pop(i)
-                            chk = True
-                            break
-                        elif a[1] == 53 and b[4]:  # b[4] checks for k_harmonic(RS)
-                            angles_solo.pop(i)
-                            chk = True
-                            break
-                        
-            if chk:
-                break
+    bonded = {}
+    for b in bonds:
+        bonded.setdefault(frozenset(b[:2]), []).append(b)
+
+    def angle_32(a):
+        for b in bonded.get(frozenset((a[0][0], a[0][2])), []):
+            if b[2] == 3: # if Morse, the list is larger then if it is harmonic
+                if (a[1] == 35 and b[7]) or (a[1] == 53 and b[4]):    # b[7] and b[4] check for k_Morse(PS) and k_Morse(RS)
+                    return True
+            elif b[2] == 1: # if harmonic
+                if (a[1] == 35 and b[6]) or (a[1] == 53 and b[4]):    # b[6] and b[4] check for k_harmonic(PS) and k_harmonic(RS)
+                    return True
+        return False
+
+    angles_solo = [a for a in angles_solo if not angle_32(a)]
 
     # returns a list with donor-acceptor atoms
     # it takes as argument bonds_x2y, not bonds_solo from which 2-4 pairs are canceled (they're present in pairs_x2y)
     # and if a soft-core is given, it won't delete its 1-4 vdW
     def donor_acceptor(bonds_x2y):
+        shared = atom_index(bonds_x2y)
         for i, b1 in enumerate(bonds_x2y[:-1]):
-            for b2 in bonds_x2y[i+1:]:
+            for j in sorted(set(shared[b1[0][0]] + shared[b1[0][1]])):
+                if j <= i:
+                    continue
+                b2 = bonds_x2y[j]
                 if (b1[1] == 25 and b2[1] == 52) or (b1[1] == 52 and b2[1] == 25):
                     if (b1[0][0] in b2[0]) or b1[0][1] in b2[0]:
                         if (b1[0][0] == b2[0][0]):
@@ -882,19 +817,58 @@ def soft_core(at_ad, bonds_solo, angles_solo, soft_at, soft_pairs):
     return soft, betas
 
 # writes tabulated tables for soft-core potential
-def gen_tables(betas, cutoff, prec):
+# with a cache directory, every table is saved there under its (beta, cutoff, precision) and
+# other runs with the same beta link (or copy) it into outdir instead of computing it again
+def gen_tables(betas, cutoff, prec, previous={}, cache=None, outdir='topologies'):
     cutoff += 1 # extends the tables by 1 more nm
     delr = 0.002
     if prec == 'double':
         delr = 0.0005
 
-    for i, beta in enumerate(betas):
-        r = 0
-        file = open(f'topologies/table_b{i}.xvg', "w")
-        while r <= cutoff:
-            file.write(f"{r:0<10.4f}       {m.exp(-beta*r):.9E}       {beta*m.exp(-beta*r):.9E}\n")
-            r += delr
-        file.close()
+    names = [f'table_b{i}.xvg' for i in range(len(betas))]
+    cached = [None]*len(betas)
+    if cache:
+        os.makedirs(cache, exist_ok=True)
+        umask = os.umask(0)
+        os.umask(umask)
+        cached = [os.path.join(cache, f'table_{beta!r}_{cutoff-1!r}_{prec}.xvg') for beta in betas]
+
+    # the grid is built from the point index, so that r does not drift as when adding delr
+    r = np.arange(int(cutoff/delr + 1e-6) + 1)*delr
+    todo = [i for i in range(len(betas)) if not (cached[i] and os.path.exists(cached[i]))]
+    data = {}
+    if todo:
+        # all the missing tables at once
+        beta = np.array([betas[i] for i in todo])[:, None]
+        ex = np.exp(-beta*r)
+        dex = beta*ex
+        col = [f'{x:0<10.4f}' for x in r.tolist()]
+        line = '%s       %.9E       %.9E\n'*len(col)
+        for k, i in enumerate(todo):
+            values = [v for row in zip(col, ex[k].tolist(), dex[k].tolist()) for v in row]
+            data[i] = (line % tuple(values)).encode()
+
+    # a table is rewritten only if its content changed since the last run
+    # the cache can be shared by replicas running at the same time, so each of them writes its own temporary file
+    tables = []
+    for i, name in enumerate(names):
+        if (i in data) and cached[i]:
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=cache)
+            try:
+                # mkstemp() makes the file readable only by its owner; the tables get the usual permissions
+                os.fchmod(fd, 0o666 & ~umask)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data[i])
+                os.replace(tmp, cached[i])
+            except:
+                os.remove(tmp)
+                raise
+        if cached[i]:
+            tables.append(link_output(name, cached[i], previous, outdir))
+        else:
+            tables.append(write_output(name, data[i], previous, outdir))
+
+    return tables
 
 # gives 1-4 and 1-5 non bonding interactions that are excluded because of the
 # forming bonds of type 3 (Morse) in PS state which generates exclusions
@@ -904,10 +878,12 @@ def restore_nb(bonds_solo, angles_solo):
     # which gets excluded by grompp because of the (morse) bond with k=0.0 in one of the states.
     nb55 = []
     # get 1-3 pairs
+    shared = atom_index(bonds_solo)
     for i, b1 in enumerate(bonds_solo[:-1]):
         at1, at2 = b1[0]
-        for b2 in bonds_solo[i+1:]:
-            if not (b1[1] == b2[1]):
+        for j in sorted(set(shared[at1] + shared[at2])):
+            b2 = bonds_solo[j]
+            if (j > i) and not (b1[1] == b2[1]):
                 at3, at4 = b2[0]
                 if at1 == at3:
                     nb55.append((at2, at4))
@@ -918,9 +894,12 @@ def restore_nb(bonds_solo, angles_solo):
                 elif at2 == at4:
                     nb55.append((at1, at3))
 
+    # angles by their end atoms
+    shared = atom_index([(a[0][0], a[0][2]) for a in angles_solo], False)
     for bond in bonds_solo:
         b1, b2 = bond[0]
-        for angle in angles_solo:
+        for j in sorted(set(shared.get(b1, []) + shared.get(b2, []))):
+            angle = angles_solo[j]
             a1, a3 = angle[0][0], angle[0][2]
             if ((bond[1] == 25) and (angle[1] == 53)):
                 if (b1 == a1):
@@ -943,11 +922,12 @@ def restore_nb(bonds_solo, angles_solo):
             
     return nb55
 
-# this method is invoked for every lambda, when generating the topology
-# it gives the NB pairs to be filled in [pairs_nb]
+# it gives the NB pairs to be filled in [pairs_nb], for all lambdas at once
 # C6 = 4*epsilon*sigma**6; C12 = 4*epsilon*sigma**12 (GROMACS manual-2020.3, pg 394)
 # in [pairs_nb] sigma does not change, epsilon=(1-l)*RS+l*PS
-def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_vdw, ps_vdw, l): # l = lambda = 0..1
+# the charge products are affine in lambda, qAB = qA*(1-l) + qB*l, so every entry keeps only qA and qB
+# (None when the term is missing for that state); nb_lambdas() gives then qAB for every frame
+def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_vdw, ps_vdw):
     func = 1
     nb_list = []   # for [pairs_nb]
     ps_list = []   # for [pairs]
@@ -962,8 +942,8 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
             q2B = float(charges[at2][1])
             qtotB = q1B*q2B
             
-            qAB = qtotB*l
-            nb_list.append([at1, at2, func, qAB, 1, '  ;2 -> 5'])
+            qA, qB = None, qtotB
+            nb_list.append([at1, at2, func, qA, qB, 1, '  ;2 -> 5'])
             
         # NB in state A
         elif b[1] == 52:
@@ -971,8 +951,8 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
             q2A = float(charges[at2][0])
             qtotA = q1A*q2A
             
-            qAB = qtotA*(1-l)
-            nb_list.append([at1, at2, func, qAB, 1, '  ;5 -> 2'])
+            qA, qB = qtotA, None
+            nb_list.append([at1, at2, func, qA, qB, 1, '  ;5 -> 2'])
     
     # add Coulomb. No vdW; it has soft core instead !!!       
     for a in angles_solo:
@@ -983,8 +963,8 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
             q3B = float(charges[at3][1])
             qtotB = q1B*q3B
             
-            qAB = qtotB*l
-            nb_list.append([at1, at3, func, qAB, 1, '  ;3 -> 5'])            
+            qA, qB = None, qtotB
+            nb_list.append([at1, at3, func, qA, qB, 1, '  ;3 -> 5'])            
         
         # NB in state A
         elif a[1] == 53:
@@ -992,8 +972,8 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
             q3A = float(charges[at3][0])
             qtotA = q1A*q3A            
             
-            qAB = qtotA*(1-l)
-            nb_list.append([at1, at3, func, qAB, 1, '  ;5 -> 3'])            
+            qA, qB = qtotA, None
+            nb_list.append([at1, at3, func, qA, qB, 1, '  ;5 -> 3'])            
             
     for p in pairs_x2y:
         at1, at4 = p[0]
@@ -1005,11 +985,10 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
                     break
                     
             if tick:
-                if l == 0 :
-                    print(f"The donor acceptor atoms {at1} and {at4} does not have soft-core repulsion.")
-                    print("Since they are 4 bonds away, 1-4 van der Waals have been added instead.")
-                    print("If you want to avoid adding 1-4 van der Waals, then add a null soft-core.")
-                    print()
+                print(f"The donor acceptor atoms {at1} and {at4} does not have soft-core repulsion.")
+                print("Since they are 4 bonds away, 1-4 van der Waals have been added instead.")
+                print("If you want to avoid adding 1-4 van der Waals, then add a null soft-core.")
+                print()
             else:
                 # 0.5*NB in state B
                 if (p[1] == 24) or (p[1] == 34):
@@ -1021,8 +1000,8 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
                     q4B = float(charges[at4][1])
                     qtotB = q1B*q4B
                     
-                    qAB = 0.5*qtotB*l
-                    nb_list.append([at1, at4, func, qAB, 1, '  ;2/3 -> 4; soft core']) 
+                    qA, qB = None, 0.5*qtotB
+                    nb_list.append([at1, at4, func, qA, qB, 1, '  ;2/3 -> 4; soft core']) 
                 
                 # 0.5*NB in state A
                 elif (p[1] == 42) or (p[1] == 43):
@@ -1034,8 +1013,8 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
                     #q4B = float(charges[at4][1])
                     #qtotB = q1B*q4Bs
                     
-                    qAB = 0.5*qtotA*(1-l)
-                    nb_list.append([at1, at4, func, qAB, 1, '  ;4 -> 2/3; soft core'])            
+                    qA, qB = 0.5*qtotA, None
+                    nb_list.append([at1, at4, func, qA, qB, 1, '  ;4 -> 2/3; soft core'])            
                     
                 #0.5*NB in state A + 1*NB in state B
                 elif p[1] == 45:
@@ -1047,8 +1026,8 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
                     q4B = float(charges[at4][1])
                     qtotB = q1B*q4B
                     
-                    qAB = 0.5*qtotA*(1-l) + qtotB*l
-                    nb_list.append([at1, at4, func, qAB, 1, '  ;4 -> 5; soft core'])            
+                    qA, qB = 0.5*qtotA, qtotB
+                    nb_list.append([at1, at4, func, qA, qB, 1, '  ;4 -> 5; soft core'])            
                 
                 # full NB in state A + 0.5 * NB in state B
                 elif p[1] == 54:
@@ -1060,8 +1039,8 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
                     q4B = float(charges[at4][1])
                     qtotB = q1B*q4B
                     
-                    qAB = qtotA*(1-l) + 0.5*qtotB*l
-                    nb_list.append([at1, at4, func, qAB, 1, '  ;5 -> 4; soft core']) 
+                    qA, qB = qtotA, 0.5*qtotB
+                    nb_list.append([at1, at4, func, qA, qB, 1, '  ;5 -> 4; soft core']) 
                 
         #else:
         if tick:
@@ -1091,9 +1070,9 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
                 e4B = float(ps_vdw[at4][1])
                 etotB = 0.5 * (e1B*e4B)**0.5
                 
-                qAB = - 0.5*qtotA*(1-l)
+                qA, qB = - 0.5*qtotA, None
                 ps_list.append([at1, at4, func, 1.0, 0.0, stotB, etotB, '  ;2/3 -> 4'])
-                nb_list.append([at1, at4, func, qAB, 1, '  ;2/3 -> 4']) 
+                nb_list.append([at1, at4, func, qA, qB, 1, '  ;2/3 -> 4']) 
             
             # 0.5*NB in state A
             elif (p[1] == 42) or (p[1] == 43):
@@ -1121,9 +1100,9 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
                 #e4B = float(ps_vdw[at4][1])
                 #etotB = (e1B*e4B)**0.5
                 
-                qAB = - 0.5*qtotB*l
+                qA, qB = None, - 0.5*qtotB
                 ps_list.append([at1, at4, func, stotA, etotA, 1.0, 0.0, '  ;4 -> 2/3'])
-                nb_list.append([at1, at4, func, qAB, 1, '  ;4 -> 2/3'])            
+                nb_list.append([at1, at4, func, qA, qB, 1, '  ;4 -> 2/3'])            
                 
             #0.5*NB in state A + 1*NB in state B
             elif p[1] == 45:
@@ -1151,9 +1130,9 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
                 e4B = float(ps_vdw[at4][1])
                 etotB = (e1B*e4B)**0.5
                 
-                qAB = 0.5*qtotB*l
+                qA, qB = None, 0.5*qtotB
                 ps_list.append([at1, at4, func, stotA, etotA, stotB, etotB, '  ;4 -> 5'])
-                nb_list.append([at1, at4, func, qAB, 1, '  ;4 -> 5'])            
+                nb_list.append([at1, at4, func, qA, qB, 1, '  ;4 -> 5'])            
             
             # full NB in state A + 0.5 * NB in state B
             elif p[1] == 54:
@@ -1181,9 +1160,9 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
                 e4B = float(ps_vdw[at4][1])
                 etotB = 0.5 * (e1B*e4B)**0.5
                 
-                qAB = 0.5*qtotA*(1-l)
+                qA, qB = 0.5*qtotA, None
                 ps_list.append([at1, at4, func, stotA, etotA, stotB, etotB, '  ;5 -> 4'])
-                nb_list.append([at1, at4, func, qAB, 1, '  ;5 -> 4'])            
+                nb_list.append([at1, at4, func, qA, qB, 1, '  ;5 -> 4'])            
             
     # restore the excluded pairs due to forming/breaking bonds which generate exclusions
     for p in nb55:
@@ -1196,10 +1175,9 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
                     break
                     
             if tick:
-                if l == 0:
-                    print(f"The donor acceptor atoms {at1} and {at2} does not have soft-core repulsion and full der Waals was added instead.")
-                    print("If you want to avoid the van der Waals interaction, then add a null soft-core (i.e., pre-exponential = 0).")
-                    print()
+                print(f"The donor acceptor atoms {at1} and {at2} does not have soft-core repulsion and full der Waals was added instead.")
+                print("If you want to avoid the van der Waals interaction, then add a null soft-core (i.e., pre-exponential = 0).")
+                print()
             else:
                 q1A = float(charges[at1][0])
                 q2A = float(charges[at2][0])
@@ -1209,8 +1187,8 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
                 q2B = float(charges[at2][1])
                 qtotB = q1B*q2B
                 
-                qAB = qtotA*(1-l) + qtotB*l
-                nb_list.append([at1, at2, func, qAB, 1, '  ;5 -> 5; soft core'])                
+                qA, qB = qtotA, qtotB
+                nb_list.append([at1, at2, func, qA, qB, 1, '  ;5 -> 5; soft core'])                
         
         if tick:
             q1A = float(charges[at1][0])
@@ -1237,229 +1215,291 @@ def pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_
             e2B = float(ps_vdw[at2][1])
             etotB = (e1B*e2B)**0.5
             
-            qAB = 0.5*qtotA*(1-l) + 0.5*qtotB*l
+            qA, qB = 0.5*qtotA, 0.5*qtotB
             ps_list.append([at1, at2, func, stotA, etotA, stotB, etotB, '  ;5 -> 5'])
-            nb_list.append([at1, at2, func, qAB, 1, '  ;5 -> 5'])
+            nb_list.append([at1, at2, func, qA, qB, 1, '  ;5 -> 5'])
         
     return nb_list, ps_list
 
+# gives qAB of all [pairs_nb] entries (columns) for all lambdas (rows) in one broadcast
+def nb_lambdas(nb_list, lambdas):
+    l = np.asarray(lambdas, dtype=float)[:, None]
+    hasA = np.array([lx[3] is not None for lx in nb_list], dtype=bool)
+    hasB = np.array([lx[4] is not None for lx in nb_list], dtype=bool)
+    qA = np.array([lx[3] if lx[3] is not None else 0.0 for lx in nb_list], dtype=float)
+    qB = np.array([lx[4] if lx[4] is not None else 0.0 for lx in nb_list], dtype=float)
+
+    # a term missing in one state is left out rather than added as 0.0, to keep the sign of a null qAB
+    qA = qA*(1-l)
+    qB = qB*l
+    return np.where(hasA & hasB, qA + qB, np.where(hasA, qA, qB))
+
+# [pairs_nb] entries as a single %-format string, filled in with the qAB of one frame
+def nb_template(nb_list):
+    template = []
+    for lx in nb_list:
+        head = f' {lx[0]:>5} {lx[1]:>5}  {lx[2]}  '
+        tail = f'  {lx[5]:4.2f}   1.00   0.00' + lx[6]
+        template.append(head.replace('%', '%%') + '%10.6f' + tail.replace('%', '%%') + '\n')
+    return ''.join(template)
+
 ### remove pairs_4x from topology - they will be inserted in [pairs_nb]
 ### !!! LJ14 chages from A to B when you change the atom_types
-def write_top(at_ad,top,atoms,bonds,angles,torsions,impropers,soft,bonds_solo,angles_solo,pairs_x2y,charges,rs_vdw,ps_vdw,feps,bconstr,nb55):
-    # define here some parameters only once
-    user = os.environ.get('USER')
-    date = datetime.now()
-    date = str(date.year)+'-'+str(date.month)+'-'+str(date.day)+' '+str(date.hour)+':'+str(date.minute)+':'+str(date.second)
+# number of atoms in the key of each directive that is changed for the EVB atoms
+evb_directives = {'atoms': 1, 'bonds': 2, 'pairs': 2, 'angles': 3, 'dihedrals': 4}
+
+# follows the directives of topol.top line by line; returns the current directive and the key of the line,
+# i.e. its atom index in [ atoms ] or the (unordered) set of its atom indexes in the other directives, or None
+def line_key(line, directive):
+    if (not line.strip()) or (line.strip()[0] == ';'): # for empty or commented lines
+        return directive, None
+    l = line.strip().split()
+    if ('[' in ''.join(l)) and (']' in ''.join(l)):
+        for d in evb_directives:
+            if f'[{d}]' in ''.join(l):
+                return d, None
+        return None, None
+    if directive and (len(l) >= evb_directives[directive]):
+        return directive, (l[0] if directive == 'atoms' else frozenset(l[:evb_directives[directive]]))
+    return directive, None
+
+# finds in the lines of topol.top where the EVB section goes ('start') and, before it, the lines of
+# [ atoms ], [ bonds ], [ pairs ], [ angles ] and [ dihedrals ], indexed by their (unordered) atom indexes;
+# the lines before 'first' (those of topol.top before the .itp of the EVB molecule) are left out
+def index_topology(lines, first=0):
+    index = {'start': None, 'atoms': {}, 'bonds': {}, 'pairs': {}, 'angles': {}, 'dihedrals': {}}
+    directive = None
+    for i, line in enumerate(lines):
+        if i < first:
+            continue
+        if "; Include Position restraint file" in line:
+            index['start'] = i - 1
+            break
+        directive, key = line_key(line, directive)
+        if key:
+            index[directive].setdefault(key, []).append(i)
+    return index
+
+# sha256 of a file, memory-mapped so that a large topol.top is not read into memory
+def file_sha(name):
+    with open(name, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.sha256(mm).hexdigest()
+        except ValueError: # empty file
+            return hashlib.sha256(b'').hexdigest()
+
+# pdb2gmx writes a topol.top that includes a .itp for each chain; the molecule with the EVB atoms is the one
+# whose [ atoms ] have all the atoms of qmatoms.dat, each with its type of the reactants state ('types'), or in
+# the residue of that type (e.g. GUW for guw_C8). Returns None if it is topol.top itself, or else (line of the
+# #include in topol.top, path of the .itp): only that .itp gets the EVB section, while the other chains,
+# the solvent, etc. are still included
+def find_molecule(top, types):
+    candidates = [(None, top)]
     with open(top) as f:
-        data = f.read().split("\n")
-        
-    #### holds the index of the inserted lines from bonds, pairs, anlges, torsions, and impropers.
-    ###b, p, a, t, it = [], [], [], [], []
-    # trigers for atoms, bonds, pairs, angles, torsions
-    # impropers are treated together with torsions
-    ats, bnds, prs, ang, tor, smth = False, False, False, False, False, False
-    
+        for i, line in enumerate(f):
+            l = line.strip().split()
+            if (len(l) == 2) and (l[0] == '#include'):
+                name = os.path.join(os.path.dirname(top), l[1].strip('"'))
+                if os.path.isfile(name):
+                    candidates.append((i, os.path.abspath(name)))
+
+    for i, name in candidates:
+        found = {}
+        directive = None
+        with open(name) as f:
+            for line in f:
+                directive, key = line_key(line, directive)
+                if key and (directive == 'atoms') and (key in types):
+                    l = line.split()
+                    found[key] = (len(l) > 3) and ((l[1] == types[key]) or (l[3].lower() == types[key].split('_')[0].lower()))
+        if all(found.get(at) for at in types):
+            return None if i is None else (i, name)
+    return None
+
+# the lines of topol.top, as in the file, with the #include of the EVB molecule replaced by the lines of its .itp
+def topology_lines(top, include=None):
+    with open(top) as f:
+        for i, line in enumerate(f):
+            if include and (i == include[0]):
+                with open(include[1]) as itp:
+                    for l in itp:
+                        yield l if l.endswith("\n") else l + "\n"
+            else:
+                yield line
 
-    ### 'smth' stays for 'someting else'
-    alist = list(atoms.keys())
-    for i, line in enumerate(data):
+# reads topol.top (with the .itp of the EVB molecule, see find_molecule()) and its index;
+# the sha256 of topol.top goes into the manifest
+def read_topology(top, include=None):
+    sha = file_sha(top)
+    with open(top) as f:
+        lines = f.read().split("\n")
+    first = 0
+    if include:
+        with open(include[1]) as f:
+            molecule = f.read().split("\n")
+        if molecule[-1] == '':
+            molecule = molecule[:-1]
+        first = include[0]
+        lines = lines[:first] + molecule + lines[first+1:]
+    index = index_topology(lines, first)
+    return sha, lines, index
+
+# the bonds of the EVB molecule in [ bonds ] of topol.top, as sets of atom indexes, for bond_graph()
+# when the topology is not indexed (with stream)
+def system_bonds(lines, first=0):
+    directive = None
+    for i, line in enumerate(lines):
+        if i < first:
+            continue
         if "; Include Position restraint file" in line:
-            start = i - 1
             break
-        if (not line.strip()) or (line.strip()[0] == ';'): # for empty or commented lines
-            continue
-        elif '[atoms]' in ''.join(line.strip().split()):
-            ats, bnds, prs, ang, tor, smth = True, False, False, False, False, False
-            continue
-        elif '[bonds]' in ''.join(line.strip().split()):
-            ats, bnds, prs, ang, tor, smth = False, True, False, False, False, False
-            continue
-        elif '[pairs]' in ''.join(line.strip().split()):
-            ats, bnds, prs, ang, tor, smth = False, False, True, False, False, False
-            continue
-        elif '[angles]' in ''.join(line.strip().split()):
-            ats, bnds, prs, ang, tor, smth = False, False, False, True, False, False
-            continue
-        elif '[dihedrals]' in ''.join(line.strip().split()):
-            ats, bnds, prs, ang, tor, smth = False, False, False, False, True, False
-            continue
-        elif ('[' in ''.join(line.strip().split())) and (']' in ''.join(line.strip().split())):
-            ats, bnds, prs, ang, tor, smth = False, False, False, False, False, True
-        else:    
-            if ats:
-                l = line.split()
-                # atlist is define before the this loop
-                if l[0] in alist:
-                    # add [type, chargeB, mass]
-                    tpA, chA = atoms[l[0]][1], atoms[l[0]][0]
-                    tpB, chB = atoms[l[0]][3], atoms[l[0]][2]
-                    # takes care of comments at the end of line
-                    if ';' in line:
-                        com = line.index(";")
-                        tail = line[com:]
-                    else:
-                        tail = ""
-                    line = f' {l[0]:>6} {tpA:>9} {l[2]:>6} {l[3]:>7} {l[4]:>5} {l[5]:>6} {chA:10.6f} {l[7]:>10} {tpB:>8} {chB:10.6f} {float(l[7]):>10}   ' + tail
-                    data[i] = line
-                        
-            elif bnds:
-                l = line.split()
-                for lx in bonds:
-                    if (l[0] in lx[:2]) and (l[1] in lx[:2]):
-                        newline = '; ' + line
-                        #newline = f' {lx[0]:>5} {lx[1]:>5}    {lx[2]}     {lx[3]}     {lx[4]}     {lx[5]}     {lx[6]}'
-                        data[i] = newline
-                        break
-                
-            elif prs:
-                l = line.split()
-                for lx in pairs_x2y:
-                    if 40 < lx[1] < 50:
-                        if (l[0] in lx[0]) and (l[1] in lx[0]):
-                            newline = '; ' + line
-                            #newline = f' {lx[0]:>5} {lx[1]:>5}    {lx[2]}     {lx[3]:.6f}     {lx[4]:.6f}     {lx[5]:.6f}     {lx[6]:.6f}'
-                            data[i] = newline
-                            break
-                            
-            elif ang:
-                l = line.split()
-                for lx in angles:
-                    if (l[0] in lx[:3]) and (l[1] in lx[:3]) and (l[2] in lx[:3]):
-                        newline = '; ' + line
-                        #newline = f' {lx[0]:>5} {lx[1]:>5} {lx[2]:>5}    {lx[3]}     {lx[4]}     {lx[5]}     {lx[6]}     {lx[7]}'
-                        data[i] = newline
-                        break
-            
-            elif tor:
-                l = line.split()
-                for lx in torsions:
-                    if (l[0] in lx[:4]) and (l[1] in lx[:4]) and (l[2] in lx[:4]) and (l[3] in lx[:4]):
-                        newline = '; ' + line
-                        #newline = f' {lx[0]:>5} {lx[1]:>5} {lx[2]:>5} {lx[3]:>5}  {lx[4]}  {lx[5]:>9}  {lx[6]:>9}  {lx[7]:>9}  {lx[8]:>9}  {lx[9]:>9}  {lx[10]:>9}  {lx[11]:>9}  {lx[12]:>9}  {lx[13]:>9}  {lx[14]:>9}  {lx[15]:>9}  {lx[16]:>9}'
-                        data[i] = newline
-                        break
-                        
-                for lx in impropers:
-                    if (l[0] in lx[:4]) and (l[1] in lx[:4]) and (l[2] in lx[:4]) and (l[3] in lx[:4]):
-                        newline = '; ' + line
-                        #newline = f' {lx[0]:>5} {lx[1]:>5} {lx[2]:>5} {lx[3]:>5}  {lx[4]}  {lx[5]:>9}  {lx[6]:>9}  {lx[7]:>9}  {lx[8]:>9}  {lx[9]:>9}  {lx[10]:>9}  {lx[11]:>9}  {lx[12]:>9}  {lx[13]:>9}  {lx[14]:>9}  {lx[15]:>9}  {lx[16]:>9}'
-                        data[i] = newline
-                        break
-
-            elif smth:
-                data[i] = line
-
-    
-    data.insert(start, '')
-    start += 1
-    data.insert(start, ';----------------------------------------')
-    start += 1
-    data.insert(start, '; This section is dedicated to EVB atoms')
-    start += 1
-    data.insert(start, ';----------------------------------------')
-    start += 1
-    data.insert(start, '')
-    start += 1    
+        directive, key = line_key(line, directive)
+        if key and (directive == 'bonds'):
+            yield key
+
+# bond graph of the whole EVB molecule, in CSR form: the neighbours of atom i are nbrs[offsets[i]:offsets[i+1]]
+def bond_graph(bonds):
+    pairs = np.array([[int(i) for i in b] for b in bonds if len(b) == 2], dtype=np.int64).reshape(-1, 2)
+    ends = np.concatenate([pairs, pairs[:, ::-1]])
+    ends = ends[np.argsort(ends[:, 0], kind='stable')]
+    offsets = np.zeros(ends[:, 0].max() + 2 if len(ends) else 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(ends[:, 0], minlength=len(offsets)-1))
+    return offsets, ends[:, 1]
+
+# atoms up to 'depth' bonds away from 'atoms', as {atom: number of bonds}; 'extra' are bonds that are
+# not in the graph, e.g. those formed in the products state
+def bonded_within(graph, atoms, depth=3, extra=()):
+    offsets, nbrs = graph
+    extra = np.array([[int(i) for i in b] for b in extra], dtype=np.int64).reshape(-1, 2)
+    extra = np.concatenate([extra, extra[:, ::-1]])
+    size = max(len(offsets) - 1, extra.max() + 1 if len(extra) else 0, max(atoms) + 1)
+    seen = np.zeros(size, dtype=bool)
+    frontier = np.unique(np.array(atoms, dtype=np.int64))
+    seen[frontier] = True
+    found = {}
+    for d in range(1, depth+1):
+        inside = frontier[frontier < len(offsets) - 1]
+        counts = offsets[inside+1] - offsets[inside]
+        idx = np.repeat(offsets[inside] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        new = np.concatenate([nbrs[idx], extra[np.isin(extra[:, 0], frontier), 1]])
+        new = np.unique(new)
+        frontier = new[~seen[new]]
+        seen[frontier] = True
+        found.update((i, d) for i in frontier.tolist())
+    return found
+
+# [ atoms ] line of an EVB atom, with its types and charges in both states
+def evb_atom_line(line, atoms):
+    l = line.split()
+    # add [type, chargeB, mass]
+    tpA, chA = atoms[l[0]][1], atoms[l[0]][0]
+    tpB, chB = atoms[l[0]][3], atoms[l[0]][2]
+    # takes care of comments at the end of line
+    if ';' in line:
+        com = line.index(";")
+        tail = line[com:]
+    else:
+        tail = ""
+    return f' {l[0]:>6} {tpA:>9} {l[2]:>6} {l[3]:>7} {l[4]:>5} {l[5]:>6} {chA:10.6f} {l[7]:>10} {tpB:>8} {chB:10.6f} {float(l[7]):>10}   ' + tail
+
+# atom keys of the EVB terms, by directive; these terms are commented out in the system topology
+def evb_keys(bonds, pairs_x2y, angles, torsions, impropers):
+    return {'bonds': {frozenset(lx[:2]) for lx in bonds},
+            'pairs': {frozenset(lx[0]) for lx in pairs_x2y if 40 < lx[1] < 50},
+            'angles': {frozenset(lx[:3]) for lx in angles},
+            'dihedrals': {frozenset(lx[:4]) for lx in torsions} | {frozenset(lx[:4]) for lx in impropers}}
+
+# lines of the EVB section, up to and including '[ pairs_nb ]'
+# with less, the section of evbless.top, made from the same terms: bonds, angles and dihedrals with null force
+# constants, and soft-core, constraints and [ pairs ] commented out (see evbless_lines())
+def evb_section(bonds, angles, torsions, impropers, soft, bconstr, nb_list, ps_list, less=False):
+    evb = []
+    evb.append('')
+    evb.append(';----------------------------------------')
+    evb.append('; This section is dedicated to EVB atoms')
+    evb.append(';----------------------------------------')
+    evb.append('')
     
     # insert bonds
     chkb = True #check if there are evb bonds
     if bonds:
         chkb = False
-        data.insert(start, '[ bonds ]')
-        start += 1
+        evb.append('[ bonds ]')
         # add harmonic and Morse bonds
-        data.insert(start, '; harmonic and Morse bonds')
-        start += 1
+        evb.append('; harmonic and Morse bonds')
         for lx in bonds:
             if int(lx[2]) == 3:
                 newline = f' {lx[0]:>5} {lx[1]:>5}    {lx[2]}     {lx[3]:>9}     {lx[4]:>9}     {lx[5]:>9}     {lx[6]:>9}     {lx[7]:>9}     {lx[8]:>9}'
-                data.insert(start, newline)
-                start += 1
+                if less:
+                    newline = f'{lx[0]:>6} {lx[1]:>5}   3   {lx[3]:>8}   0.0    {lx[5]:>5}'
+                evb.append(newline)
             elif (lx[2]) == 1:
                 newline = f' {lx[0]:>5} {lx[1]:>5}    {lx[2]}     {lx[3]:>9}     {lx[4]:>9}     {lx[5]:>9}     {lx[6]:>9}'
-                data.insert(start, newline)
-                start += 1
+                if less:
+                    newline = f'{lx[0]:>6} {lx[1]:>5}   1   {lx[3]:>8}   0.0'
+                evb.append(newline)
             
     # add soft-core as tabulated bonds of type 9
     if soft:
         if chkb:
             chkb = False
-            data.insert(start, '[ bonds ]')
-            start += 1
+            evb.append('[ bonds ]')
 
-        data.insert(start, '; soft-core potential')
-        start += 1
+        evb.append('; soft-core potential')
         for lx in soft:
             newline = f' {lx[0]:>5} {lx[1]:>5}    {lx[2]}    {lx[3]}  {lx[4]:12.2f}    {lx[5]}  {lx[6]:12.2f}  ; beta = {lx[7]:.2f}'
-            data.insert(start, newline)
-            start += 1
+            evb.append(';' + newline if less else newline)
     
     # add bond constraints
     if bconstr:
         if chkb:
             chkb = False
-            data.insert(start, '[ bonds ]')
-            start += 1
+            evb.append('[ bonds ]')
 
-        data.insert(start, '; constraints')
-        start += 1
+        evb.append('; constraints')
         for lx in bconstr:
-            data.insert(start, lx)
-            start += 1
-    data.insert(start, '')
-    start += 1
+            evb.append(';' + lx if less else lx)
+    evb.append('')
     
     # insert angles
     if angles:
-        data.insert(start, '[ angles ]')
-        start += 1
+        evb.append('[ angles ]')
         for lx in angles:
             newline = f' {lx[0]:>5} {lx[1]:>5} {lx[2]:>5}    {lx[3]}     {lx[4]:>9}     {lx[5]:>9}     {lx[6]:>9}     {lx[7]:>9}'
-            data.insert(start, newline)
-            start += 1
-        data.insert(start, '')
-        start += 1
+            if less:
+                newline = f'{lx[0]:>6} {lx[1]:>5} {lx[2]:>5}   1   {lx[4]:>8}   0.0'
+            evb.append(newline)
+        evb.append('')
     
     # insert torsions
     if torsions:
-        data.insert(start, '[ dihedrals ]')
-        start += 1
+        evb.append('[ dihedrals ]')
         # add proper dihedrals
-        data.insert(start, '; proper dihedrals')
-        start += 1
+        evb.append('; proper dihedrals')
         for lx in torsions:
             newline = f' {lx[0]:>5} {lx[1]:>5} {lx[2]:>5} {lx[3]:>5}  {lx[4]}  {lx[5]:>9}  {lx[6]:>9}  {lx[7]:>9}  {lx[8]:>9}  {lx[9]:>9}  {lx[10]:>9}  {lx[11]:>9}  {lx[12]:>9}  {lx[13]:>9}  {lx[14]:>9}  {lx[15]:>9}  {lx[16]:>9}'
-            data.insert(start, newline)
-            start += 1
+            evb += evbless_dihedral(lx) if less else [newline]
 
     # add improper dihedrals
     if impropers:
         if not torsions:
-            data.insert(start, '[ dihedrals ]')
-            start += 1
-        data.insert(start, '; improper dihedrals')
-        start += 1
+            evb.append('[ dihedrals ]')
+        evb.append('; improper dihedrals')
         for lx in impropers:
             newline = f' {lx[0]:>5} {lx[1]:>5} {lx[2]:>5} {lx[3]:>5}  {lx[4]}  {lx[5]:>9}  {lx[6]:>9}  {lx[7]:>9}  {lx[8]:>9}'
-            data.insert(start, newline)
-            start += 1
-        data.insert(start, '')
-        start += 1
+            evb += evbless_dihedral(lx) if less else [newline]
+        evb.append('')
             
     # inserts [exclusions]
-    nb_list, ps_list = pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_vdw, ps_vdw, 1)
     if nb_list:
-        data.insert(start, '[ exclusions ]')
-        start += 1 
+        evb.append('[ exclusions ]')
         for lx in nb_list:
-            data.insert(start, f' {lx[0]}   {lx[1]}')
-            start += 1
-        data.insert(start, "")
-        start += 1
+            evb.append(f' {lx[0]}   {lx[1]}')
+        evb.append("")
     
         # insert pairs
-        data.insert(start, '[ pairs ]')
-        start += 1
+        evb.append('[ pairs ]')
         for lx in ps_list:
             newline = f' {lx[0]}   {lx[1]}    {lx[2]}   {lx[3]:>10.6f}  {lx[4]:>10.6f}  {lx[5]:>10.6f}  {lx[6]:>10.6f}'
             try:
@@ -1467,50 +1507,18 @@ def write_top(at_ad,top,atoms,bonds,angles,torsions,impropers,soft,bonds_solo,an
                     newline = newline+lx[7]
             except:
                 pass
-            data.insert(start, newline)
-            start += 1
-        data.insert(start, "")
-        start += 1    
-    
-    # do it here because a top with different [ pairs_nb ] will be built for each FEP frame
-    try:
-        os.mkdir('topologies')
-    except FileExistsError:
-        pass
-    
-    # insert pairs_nb
-    data.insert(start, '[ pairs_nb ]')
-    start += 1
-    nb_start = start
-    for i in range(feps):
-        nb, _ = pairs_nb(at_ad, soft, nb55, bonds_solo, angles_solo, pairs_x2y, charges, rs_vdw, ps_vdw, i/(feps-1))
-        
-        ## I use the if/else for not building the topology from the beginning each time
-        if i == 0:
-            for lx in nb:
-                newline = f' {lx[0]:>5} {lx[1]:>5}  {lx[2]}  {lx[3]:>10.6f}  {lx[4]:4.2f}   1.00   0.00'
-                try:
-                    if str(lx[5]):
-                        newline = newline + lx[5]
-                except:
-                    pass
-                data.insert(start, newline)
-                start += 1
-            #data.insert(start, '')
-            #start += 1
-        
-        elif i > 0:
-            for j, lx in enumerate(nb):
-                newline = f' {lx[0]:>5} {lx[1]:>5}  {lx[2]}  {lx[3]:>10.6f}  {lx[4]:4.2f}   1.00   0.00'
-                try:
-                    if str(lx[5]):
-                        newline = newline + lx[5]
-                except:
-                    pass
-                data[nb_start+j] = newline
-                
-        with open(f'topologies/topol_{i:0>3}.top', "w") as f:
-            f.write(f'''; Topology for EVB simulation in Gromacs, generated with gmx4evb.py
+            evb.append(';' + newline if less else newline)
+        evb.append("")
+
+    evb.append('[ pairs_nb ]')
+    return evb
+
+# header of every topology; the User and Date lines are left out of the fingerprints
+def topology_header():
+    user = os.environ.get('USER')
+    date = datetime.now()
+    date = str(date.year)+'-'+str(date.month)+'-'+str(date.day)+' '+str(date.hour)+':'+str(date.minute)+':'+str(date.second)
+    return f'''; Topology for EVB simulation in Gromacs, generated with gmx4evb.py
 ; User: {user}
 ; Date: {date}
 ; For download and updates, vizit or clone:
@@ -1518,25 +1526,431 @@ def write_top(at_ad,top,atoms,bonds,angles,torsions,impropers,soft,bonds_solo,an
 ;     git@github.com:gabrieloanca/gmxtools
 ; For suggestions, reporting buggs or for any assistance write to oanca.gabriel@gmail.com
 ; ---------------------------------------------------------------------------------------
-''')
-            for l in data:
-                f.write(str(l)+'\n')
-                
-### this function reads topol_000.top and writes out a topology in which all atoms in region 1 will have dummy types
+'''
+
+# 'lines' are the lines of topol.top (see read_topology()) and 'index' is given by index_topology(); they are not changed,
+# so the same topology can be written many times
+def write_top(lines,index,atoms,bonds,angles,torsions,impropers,soft,pairs_x2y,bconstr,nb_list,ps_list,lambdas,names,shared=False,jobs=1,du=None,previous={},outdir='topologies'):
+    data = list(lines)
+    start = index['start']
+    if start is None:
+        raise ValueError('"; Include Position restraint file" was not found in the topology')
+
+    for at in atoms:
+        for i in index['atoms'].get(at, []):
+            data[i] = evb_atom_line(data[i], atoms)
+
+    # the EVB terms are commented out in the system topology, whatever the order of the atoms in the line
+    for directive, keys in evb_keys(bonds, pairs_x2y, angles, torsions, impropers).items():
+        for key in keys:
+            for i in index[directive].get(key, []):
+                data[i] = '; ' + data[i]
+
+    # the EVB section is inserted at 'start' in one go
+    terms = (bonds, angles, torsions, impropers, soft, bconstr, nb_list, ps_list)
+    evb = evb_section(*terms)
+
+    # do it here because a top with different [ pairs_nb ] will be built for each FEP frame
+    os.makedirs(outdir, exist_ok=True)
+    
+    header = topology_header()
+
+    # everything but [ pairs_nb ] is the same for all frames, so it gets encoded only once
+    # and each topology is written as header + prefix + [ pairs_nb ] entries + suffix
+    head = data[:start] + evb[:-1]
+    tail = data[start:]
+    del(data, evb)
+    suffix = ('\n'.join(tail) + '\n').encode()
+
+    # the frame-invariant part goes into topol_head.itp (up to [ pairs_nb ]) and topol_tail.itp (the rest),
+    # while topol_XXX.top only includes them around its own [ pairs_nb ] entries
+    others = []
+    if shared:
+        others.append(write_output('topol_head.itp', ('\n'.join(head) + '\n').encode(), previous, outdir))
+        others.append(write_output('topol_tail.itp', suffix, previous, outdir))
+        prefix = '#include "topol_head.itp"\n[ pairs_nb ]\n'.encode()
+        suffix = b'#include "topol_tail.itp"\n'
+    else:
+        prefix = ('\n'.join(head + ['[ pairs_nb ]']) + '\n').encode()
+
+    # [ pairs_nb ] for all the frames; evbless.top is always made from lambda = 0
+    qAB = nb_lambdas(nb_list, np.asarray(lambdas, dtype=float))
+    template = nb_template(nb_list)
+    block0 = template % tuple(nb_lambdas(nb_list, np.zeros(1))[0].tolist())
+
+    # the frames are independent of each other, so with jobs > 1 they are written by a pool of processes;
+    # evbless.top is built from the same parts as topol_000.top, here, while the frames are being written
+    frames = []
+    initargs = (header.encode(), prefix, suffix, template, previous, outdir)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_frames, initargs=initargs) as pool:
+            futures = [pool.submit(write_frame, name, qAB[i].tolist()) for i, name in enumerate(names)]
+            if du is not None:
+                others += evbless_job(header, head, start, index, terms, block0, tail, du, shared, previous, outdir)
+            for future in futures:
+                frames.append(future.result())
+    else:
+        init_frames(*initargs)
+        for i, name in enumerate(names):
+            frames.append(write_frame(name, qAB[i].tolist()))
+        if du is not None:
+            others += evbless_job(header, head, start, index, terms, block0, tail, du, shared, previous, outdir)
+
+    return frames, others
+
+# fingerprint of a generated file: sha256 of its content without the '; User:' and '; Date:' lines,
+# so that a file is not rewritten only because somebody else generated it, or at another time
+stamp_lines = re.compile(rb'^; (User|Date):.*\n', re.M)
+
+def fingerprint(data):
+    return hashlib.sha256(stamp_lines.sub(b'', data)).hexdigest()
+
+# True if outdir/name is still there, with the size recorded in the previous manifest
+def intact(name, previous, outdir='topologies'):
+    try:
+        return os.path.getsize(os.path.join(outdir, name)) == previous[name][0]
+    except (OSError, KeyError):
+        return False
+
+# True if outdir/name is intact and has the fingerprint recorded in the previous manifest
+def unchanged(name, fp, previous, outdir='topologies'):
+    return (previous.get(name, (None, None))[1] == fp) and intact(name, previous, outdir)
+
+# the outputs are written in outdir/<name>.tmp and then moved in place, so that a run that stops halfway
+# never leaves a truncated file behind; the old file may be a link to the table cache, so it is replaced and
+# not written through, and so is a <name>.tmp left by such a run
+def temp_output(name, outdir='topologies'):
+    tmp = os.path.join(outdir, f'{name}.tmp')
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    return tmp
+
+def put_output(name, parts, outdir='topologies'):
+    tmp = temp_output(name, outdir)
+    with open(tmp, "wb") as f:
+        for data in parts:
+            f.write(data)
+    os.replace(tmp, os.path.join(outdir, name))
+
+# writes outdir/name only if its content changed and returns (file name, size, fingerprint)
+def write_output(name, data, previous, outdir='topologies'):
+    fp = fingerprint(data)
+    if unchanged(name, fp, previous, outdir):
+        return name, len(data), fp
+    put_output(name, (data,), outdir)
+    return name, len(data), fp
+
+# same as write_output(), for a file that is already written elsewhere (e.g. in the table cache);
+# it gets hard linked in outdir, or copied where links are not possible
+def link_output(name, source, previous, outdir='topologies'):
+    with open(source, "rb") as f:
+        data = f.read()
+    fp = fingerprint(data)
+    if unchanged(name, fp, previous, outdir):
+        return name, len(data), fp
+    tmp = temp_output(name, outdir)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, os.path.join(outdir, name))
+    return name, len(data), fp
+
+# header, prefix, suffix and [ pairs_nb ] template shared by all the frames (and by all the processes writing them)
+frame_parts = {}
+
+def init_frames(header, prefix, suffix, template, previous, outdir):
+    frame_parts['header'] = header
+    frame_parts['prefix'] = prefix
+    frame_parts['suffix'] = suffix
+    frame_parts['template'] = template
+    frame_parts['previous'] = previous
+    frame_parts['outdir'] = outdir
+    # the prefix is the largest part of a topology, so its hash is computed only once
+    frame_parts['hash'] = hashlib.sha256(stamp_lines.sub(b'', header) + prefix)
+
+# writes the topology of a frame, unless it did not change, and returns (file name, size, fingerprint)
+def write_frame(name, q):
+    block = (frame_parts['template'] % tuple(q)).encode()
+    sha = frame_parts['hash'].copy()
+    sha.update(block)
+    sha.update(frame_parts['suffix'])
+    fp = sha.hexdigest()
+    size = len(frame_parts['header']) + len(frame_parts['prefix']) + len(block) + len(frame_parts['suffix'])
+    if not unchanged(name, fp, frame_parts['previous'], frame_parts['outdir']):
+        put_output(name, (frame_parts['header'], frame_parts['prefix'], block, frame_parts['suffix']), frame_parts['outdir'])
+    return name, size, fp
+
+def evbless_job(header, head, start, index, terms, block, tail, du, shared, previous, outdir):
+    try:
+        return evb_less(header, head, start, index, terms, block, tail, du, shared, previous, outdir)
+    except:
+        print('evbless.top file could not be written')
+        return []
+
+# output written piece by piece into outdir/<name>.tmp; close() puts it in place only if its fingerprint changed
+class StreamOutput:
+    def __init__(self, name, outdir='topologies'):
+        self.name, self.outdir = name, outdir
+        self.path = os.path.join(outdir, name)
+        self.f = open(temp_output(name, outdir), "wb")
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.sha.update(stamp_lines.sub(b'', data))
+        self.size += len(data)
+
+    def close(self, previous):
+        self.f.close()
+        fp = self.sha.hexdigest()
+        if unchanged(self.name, fp, previous, self.outdir):
+            os.remove(self.path + '.tmp')
+            return self.name, self.size, fp
+        os.replace(self.path + '.tmp', self.path)
+        return self.name, self.size, fp
+
+    def discard(self):
+        self.f.close()
+        os.remove(self.path + '.tmp')
+
+# reads topol.top line by line (as the items of f.read().split("\n")) and yields them in chunks, as ('head', lines)
+# up to the line where the EVB section goes, and as ('tail', lines) after it; the [ atoms ] lines of the EVB atoms
+# and the EVB terms of the head are changed as in write_top()
+def stream_topology(top, atoms, keys, include=None, size=10000):
+    directive = None
+    part = 'head'
+    held = None   # the line before "; Include Position restraint file" is the first one of the tail
+    chunk = []
+    newline = True
+    first = include[0] if include else 0
+    for i, line in enumerate(topology_lines(top, include)):
+        newline = line.endswith("\n")
+        if newline:
+            line = line[:-1]
+        if (part == 'head') and (i >= first):
+            if "; Include Position restraint file" in line:
+                yield part, chunk
+                part, chunk = 'tail', ([held] if held is not None else [])
+                held = None
+            else:
+                directive, key = line_key(line, directive)
+                if key and (directive == 'atoms') and (key in atoms):
+                    line = evb_atom_line(line, atoms)
+                elif key and (directive != 'atoms') and (key in keys[directive]):
+                    line = '; ' + line
+                line, held = held, line
+                if line is None:
+                    continue
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield part, chunk
+            chunk = []
+    if part == 'head':
+        raise ValueError('"; Include Position restraint file" was not found in the topology')
+    # the empty string after the last newline
+    if newline:
+        chunk.append('')
+    yield part, chunk
+
+# same as write_top(), but topol.top is read and the topologies are written chunk by chunk, all the frames
+# at once, so that only the EVB terms are kept in memory, whatever the size of the system
+def stream_top(top,atoms,bonds,angles,torsions,impropers,soft,pairs_x2y,bconstr,nb_list,ps_list,lambdas,names,shared=False,du=None,previous={},include=None,outdir='topologies'):
+    os.makedirs(outdir, exist_ok=True)
+    keys = evb_keys(bonds, pairs_x2y, angles, torsions, impropers)
+    terms = (bonds, angles, torsions, impropers, soft, bconstr, nb_list, ps_list)
+    evb = evb_section(*terms)
+    header = topology_header()
+
+    qAB = nb_lambdas(nb_list, np.asarray(lambdas, dtype=float))
+    template = nb_template(nb_list)
+    blocks = [(template % tuple(q)).encode() for q in qAB.tolist()]
+    block0 = template % tuple(nb_lambdas(nb_list, np.zeros(1))[0].tolist())
+    encode = lambda chunk: ''.join(l + '\n' for l in chunk).encode()
+
+    # with --shared the system goes into topol_head.itp and topol_tail.itp, and the frames are written at the end;
+    # otherwise it goes into every frame as it is read. evbless.top follows topol_000.top, as in evb_less()
+    outputs = []
+    try:
+        if shared:
+            heads, tails = [StreamOutput('topol_head.itp', outdir)], [StreamOutput('topol_tail.itp', outdir)]
+            outputs += heads + tails
+        else:
+            heads = tails = [StreamOutput(name, outdir) for name in names]
+            outputs += heads
+            for out in heads:
+                out.write(header.encode())
+
+        less = None
+        if du is not None:
+            state = {'trigger': None, 'evb': False}
+            less_top = evbless_lines(header.split("\n")[:-1], du, 'evbless.top', state)
+            less = {'head': StreamOutput('evbless_head.itp' if shared else 'evbless.top', outdir)}
+            less['tail'] = StreamOutput('evbless_tail.itp', outdir) if shared else less['head']
+            changed = False
+            if not shared:
+                less['head'].write(encode(less_top))
+
+        for part, chunk in stream_topology(top, atoms, keys, include):
+            # the EVB section closes the head and, in every frame, it is followed by its [ pairs_nb ]
+            if (part == 'tail') and (evb is not None):
+                for out in heads:
+                    out.write(encode(evb[:-1]))
+                if not shared:
+                    for out, block in zip(heads, blocks):
+                        out.write(b'[ pairs_nb ]\n' + block)
+                if less:
+                    try:
+                        less['head'].write(encode(evb_section(*terms, less=True)[:-1]))
+                        pairs = ['[ pairs_nb ]'] + [';' + line for line in block0.split("\n")[:-1]]
+                        state['trigger'], state['evb'] = 'pairs_nb', True
+                        if shared:
+                            less_top += ['#include "evbless_head.itp"'] + pairs
+                        else:
+                            less['head'].write(encode(pairs))
+                    except:
+                        print('evbless.top file could not be written')
+                        for out in set(less.values()):
+                            out.discard()
+                        less = None
+                evb = None
+
+            data = encode(chunk)
+            for out in (heads if part == 'head' else tails):
+                out.write(data)
+            if less:
+                try:
+                    new = evbless_lines(chunk, du, 'evbless.top', state)
+                    less[part].write(encode(new))
+                    changed = changed or ((part == 'tail') and (new != chunk))
+                except:
+                    print('evbless.top file could not be written')
+                    for out in set(less.values()):
+                        out.discard()
+                    less = None
+    except:
+        for out in outputs + (list(set(less.values())) if less else []):
+            if not out.f.closed:
+                out.discard()
+        raise
+
+    frames, others = [], []
+    if shared:
+        others += [heads[0].close(previous), tails[0].close(previous)]
+        prefix = header.encode() + b'#include "topol_head.itp"\n[ pairs_nb ]\n'
+        for name, block in zip(names, blocks):
+            frames.append(write_output(name, prefix + block + b'#include "topol_tail.itp"\n', previous, outdir))
+    else:
+        frames = [out.close(previous) for out in heads]
+
+    if less:
+        if shared:
+            others.append(less['head'].close(previous))
+            # topol_tail.itp is referenced as it is, unless evbless.top needs to change something in it
+            if changed:
+                others.append(less['tail'].close(previous))
+                less_top.append('#include "evbless_tail.itp"')
+            else:
+                less['tail'].discard()
+                less_top.append('#include "topol_tail.itp"')
+            less_top += evbless_lines([''], du, 'evbless.top', state)
+            others.append(write_output('evbless.top', encode(less_top), previous, outdir))
+        else:
+            less['head'].write(encode(evbless_lines([''], du, 'evbless.top', state)))
+            others.append(less['head'].close(previous))
+
+    return frames, others
+
+# sha256 of the inputs of a run: topol.top, qmatoms.dat, the .opls files, gmx4evb.py itself and the options
+def input_hashes(files, options, known={}):
+    inputs = {}
+    for file in files:
+        if file in known:
+            inputs[os.path.basename(file)] = known[file]
+            continue
+        with open(file, "rb") as f:
+            inputs[os.path.basename(file)] = hashlib.sha256(f.read()).hexdigest()
+    inputs['options'] = hashlib.sha256(repr(options).encode()).hexdigest()
+    return inputs
+
+# reads outdir/manifest.dat from a previous run; returns the input hashes and the (size, fingerprint) of the outputs
+def read_manifest(outdir='topologies'):
+    inputs, outputs = {}, {}
+    try:
+        with open(os.path.join(outdir, 'manifest.dat')) as f:
+            data = f.read().split("\n")
+    except OSError:
+        return inputs, outputs
+
+    section = None
+    for line in data:
+        line = line.split()
+        if (not line) or line[0].startswith(';'):
+            continue
+        if line[0] == '[':
+            section = line[1]
+        elif section == 'inputs' and len(line) == 2:
+            inputs[line[1]] = line[0]
+        elif section == 'outputs' and len(line) == 5:
+            # {file: (size, fingerprint, frame, lambda)}
+            outputs[line[2]] = (int(line[3]), line[4], line[0], line[1])
+    return inputs, outputs
+
+# outdir/manifest.dat lists the inputs and all the files written in outdir, in the same order
+# for every run, whatever the order in which the processes have finished them
+# the files listed in the previous manifest that were not written again, but are still there, are kept at the end
+def write_manifest(inputs, frames, lambdas, others, previous={}, outdir='topologies'):
+    written = {name for name, size, fp in frames + others}
+    kept = [(name, out) for name, out in previous.items() if not (name in written) and os.path.exists(os.path.join(outdir, name))]
+    tmp = temp_output('manifest.dat', outdir)
+    with open(tmp, "w") as f:
+        f.write('; files generated by gmx4evb.py\n')
+        f.write('[ inputs ]\n')
+        f.write('; sha256                                                           input\n')
+        for name, sha in inputs.items():
+            f.write(f'{sha}  {name}\n')
+        f.write('[ outputs ]\n')
+        f.write(';  frame      lambda  file                      bytes  fingerprint\n')
+        for i, (name, size, fp) in enumerate(frames):
+            frame = i if name == f'topol_{i:0>3}.top' else '-'
+            f.write(f'{frame:>8}  {lambdas[i]:10.6f}  {name:<20}  {size:>10}  {fp}\n')
+        for name, size, fp in others:
+            f.write(f'{"-":>8}  {"-":>10}  {name:<20}  {size:>10}  {fp}\n')
+        for name, (size, fp, frame, lam) in kept:
+            f.write(f'{frame:>8}  {lam:>10}  {name:<20}  {size:>10}  {fp}\n')
+    os.replace(tmp, os.path.join(outdir, 'manifest.dat'))
+
+### this function takes the lines of topol_000.top and writes out a topology in which all atoms in region 1 will have dummy types
 ### exclusions will be preserved, soft-core, pair_nb and constraints will be commented out, and bonds, angles,
 ### torsions and impropers will be set to 0.
 ### The dummy types must preserve the original bonding types (in ffnonbonded.itp) - this way, the connectivities
 ### between region 1 and region 2 will be conserved. These dummy types needs to be added to ffnonbonded.itp 
 ### and atomtypes.atp files of the force field.
-def evb_less(top, name, du):  
+# the [ atoms ] line of an EVB atom in evbless.top, from the fields of its line in topol_XXX.top
+def evbless_atom_line(l, du):
+    return f'{l[0]:>6} {du[l[0]]:>10} {l[2]:>6} {l[3]:>6} {l[4]:>6} {l[5]:>6}        0.0   {l[7]:>8}'
+
+# a dihedral of evbless.top, with a null force constant, from the fields of the dihedral
+def evbless_dihedral(l, where='evbless.top'):
+    if int(l[4]) == 3:
+        return [f'{l[0]:>6} {l[1]:>5} {l[2]:>5} {l[3]:>5}   3     0.0   0.0   0.0   0.0   0.0   0.0']
+    elif int(l[4]) == 2:
+        return [f'{l[0]:>6} {l[1]:>5} {l[2]:>5} {l[3]:>5}   2   {l[5]:>8}     0.0']
+    elif (int(l[4]) == 1) or (int(l[4]) == 4):
+        return [f'{l[0]:>6} {l[1]:>5} {l[2]:>5} {l[3]:>5} {l[4]:>2}   {l[5]:>8}     0.0   {l[7]:>3}']
+    print(f'WARNING! The dihetral between atoms {l[0]} {l[1]} {l[2]} {l[3]} could not be set ot 0.0')
+    print(f'The current force constant is {l[6]}; change its value to 0.0 in {where}')
+    return []
+
+# runs through the lines of a topology and returns them as in evbless.top
+# 'state' keeps the current directive, so a topology split over several files can be read piece by piece
+def evbless_lines(data, du, name, state):
     ati = list(du.keys())   # holds QM-atom indexes
-
-    with open(f'topologies/{top}') as f:
-        data = f.read().split("\n")
     
     new_top = []
-    trigger = None # it shows which directive is currently reading
-    evb = False    # it shows if it's reading the EVB section
+    trigger = state['trigger'] # it shows which directive is currently reading
+    evb = state['evb']         # it shows if it's reading the EVB section
     
     for i, line in enumerate(data):
         if "This section is dedicated to EVB atoms" in line:
@@ -1605,9 +2019,7 @@ def evb_less(top, name, du):
             
         if trigger == "atoms":
             if l[0] in ati:
-                dummyA = du[l[0]]
-                newline = f'{l[0]:>6} {dummyA:>10} {l[2]:>6} {l[3]:>6} {l[4]:>6} {l[5]:>6}        0.0   {l[7]:>8}'
-                new_top.append(newline)
+                new_top.append(evbless_atom_line(l, du))
             else:
                 new_top.append(line)  
             continue
@@ -1636,18 +2048,7 @@ def evb_less(top, name, du):
             continue
             
         elif trigger == 'dihedrals':
-            if int(l[4]) == 3:
-                newline = f'{l[0]:>6} {l[1]:>5} {l[2]:>5} {l[3]:>5}   3     0.0   0.0   0.0   0.0   0.0   0.0'
-                new_top.append(newline)
-            elif int(l[4]) == 2:
-                newline = f'{l[0]:>6} {l[1]:>5} {l[2]:>5} {l[3]:>5}   2   {l[5]:>8}     0.0'
-                new_top.append(newline)
-            elif (int(l[4]) == 1) or (int(l[4]) == 4):
-                newline = f'{l[0]:>6} {l[1]:>5} {l[2]:>5} {l[3]:>5} {l[4]:>2}   {l[5]:>8}     0.0   {l[7]:>3}'
-                new_top.append(newline)
-            else:
-                print(f'WARNING! The dihetral between atoms {l[0]} {l[1]} {l[2]} {l[3]} could not be set ot 0.0')
-                print(f'The current force constant is {l[6]}; change its value to 0.0 in {name}.top, at line {i}')
+            new_top += evbless_dihedral(l, f'{name}.top, at line {i}')
             continue
         
         #if trigger == 'exclusions':
@@ -1663,106 +2064,436 @@ def evb_less(top, name, du):
   
         else:
             new_top.append(line)
-                
-    with open(f'topologies/{name}', "w") as f:
-        for l in new_top:
-            f.write(str(l) + '\n')
 
+    state['trigger'], state['evb'] = trigger, evb
+    return new_top
+
+# evbless.top is put together from the same parts as topol_000.top: in the system ('head' up to 'start') only the
+# [ atoms ] lines of the EVB atoms change, found through 'index', the EVB section is made again from the EVB terms
+# ('terms', as given to evb_section()), and the tail is used as it is, unless evbless_lines() changes something in it
+def evb_less(header, head, start, index, terms, block, tail, du, shared=False, previous={}, outdir='topologies'):
+    system = head[:start]
+    for at in du:
+        for i in index['atoms'].get(at, []):
+            system[i] = evbless_atom_line(system[i].split(), du)
+    evb = evb_section(*terms, less=True)
+    pairs = ['[ pairs_nb ]'] + [';' + line for line in block.split("\n")[:-1]]
+
+    # the tail starts within [ pairs_nb ] of the EVB section
+    state = {'trigger': 'pairs_nb', 'evb': True}
+    new_tail = evbless_lines(tail, du, 'evbless.top', state)
+    tail_data = ''.join(str(l) + '\n' for l in new_tail)
+
+    if not shared:
+        data = header + '\n'.join(system + evb[:-1] + pairs) + '\n' + tail_data + '\n'
+        return [write_output('evbless.top', data.encode(), previous, outdir)]
+
+    # with --shared, topol_head.itp gets its own evbless_head.itp, while topol_tail.itp is
+    # referenced as it is, unless evbless.top needs to change something in it as well
+    written = [write_output('evbless_head.itp', ('\n'.join(system + evb[:-1]) + '\n').encode(), previous, outdir)]
+    new_top = header + '#include "evbless_head.itp"\n' + '\n'.join(pairs) + '\n'
+    if new_tail == tail:
+        new_top += '#include "topol_tail.itp"\n'
+    else:
+        written.append(write_output('evbless_tail.itp', tail_data.encode(), previous, outdir))
+        new_top += '#include "evbless_tail.itp"\n'
+
+    written.append(write_output('evbless.top', (new_top + '\n').encode(), previous, outdir))
+    return written
+
+
+### gmx4evb.py can also be imported, e.g. to build the topologies of many replicas in the same process:
+###     from gmx4evb import Topology
+###     topology = Topology('topol.top', 'qmatoms.dat', ['guw', 'sub'], ['ghw', 'sum'])
+###     topology.build()
+###     topology.write_tables(1.0, 'single')
+###     topology.write(51)
+### the files are written in topologies/, or in the directory given as outdir to write_tables() and write()
+### the EVB terms are given as the records below by evb_atoms(), bonded_terms(), soft_pairs() and nb_pairs()
+
+# small records with fixed fields, without a __dict__ for each of them
+class Record:
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return (type(self) is type(other)) and (tuple(self) == tuple(other))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+# region 1 atom, with its type and charge in both states
+class EvbAtom(Record):
+    __slots__ = ('index', 'typeA', 'chargeA', 'typeB', 'chargeB')
+
+# kind is 'bonds', 'angles', 'torsions' or 'impropers'; params holds the RS and then the PS parameters
+class BondedTerm(Record):
+    __slots__ = ('kind', 'atoms', 'func', 'params')
+
+# tabulated bond of type 9; tableA/tableB are the indexes of the table_b{i}.xvg files
+class SoftPair(Record):
+    __slots__ = ('atoms', 'tableA', 'A_A', 'tableB', 'A_B', 'beta')
+
+# [ pairs_nb ] entry; qA and qB are the charge products in RS and PS (None if the pair is not there)
+class PairNB(Record):
+    __slots__ = ('atoms', 'func', 'qA', 'qB', 'comment')
+
+# EVB topology: topol.top, qmatoms.dat and the .opls files are read once, when the object is made,
+# build() generates the EVB terms and write_tables()/write() can then write them as many times as needed
+class Topology:
+    def __init__(self, top='topol.top', qmatoms='qmatoms.dat', rs=(), ps=(), stream=False):
+        self.top, self.qmatoms, self.rs, self.ps = top, qmatoms, list(rs), list(ps)
+        self.built = False
+        # the 1-4 pairs depend only on topol.top, the .opls files and [ atoms ]; the variants share this dict with
+        # the topology they come from, so the first one that gets built fills it for all of them
+        self.common = {}
+
+        with open(qmatoms) as f:
+            self.read_qm(f.read().split("\n"))
+
+        self.rs_files, self.ps_files = {}, {}
+        if self.rs:
+            try:
+                self.rs_files = filelist(self.rs, top)
+            except:
+                print(f'{self.rs} files could not be opened')
+                raise
+        else:
+            print("There are no parameter files for reactants state.")
 
-if __name__ == "__main__":
-    feps, qmatoms, top, rs, ps, cutoff, prec = get_args()
-    if prec not in ['single', 'double']:
-        print("Precision can only be 'single' or 'double' (default: single).")
-        sys.exit()
-
-    qpdb, q1, q2, du, charges, soft_at, bevb, bconstr, soft_pairs, aevb, torevb, impevb = read_qm(qmatoms, rs, ps)
+        if self.ps:
+            try:
+                self.ps_files = filelist(self.ps, top)
+            except:
+                print(f'{self.ps} files could not be opened')
+                raise
+        else:
+            print("There are no parameter files for products state.")
 
-    if rs:
+        # all the .opls files are parsed only once and shared by the list builders
         try:
-            rs_files = filelist(rs, top)
+            self.opls = sorted(set(j for files in (self.rs_files, self.ps_files) for i in files for j in files[i]))
+            parsed = read_opls([j for files in (self.rs_files, self.ps_files) for i in files for j in files[i]])
+            self.stores = {'rs': opls_store(self.rs, self.rs_files, parsed), 'ps': opls_store(self.ps, self.ps_files, parsed)}
         except:
-            print(f'{rs} files could not be opened')
-            sys.exit()
-    else:
-        print("There are no parameter files for reactants state.")
-        
-    if ps:
+            print('The .opls files could not be read')
+            raise
+
+        # the EVB atoms may be in one of the .itp files included by topol.top
         try:
-            ps_files = filelist(ps)
+            types = {at: tp for residues in self.qpdb['rs'] for tp, (at, region) in residues.items()}
+            self.include = find_molecule(top, types)
         except:
-            print(f'{ps} files could not be opened')
-            sys.exit()
-    else:
-        print("There are no parameter files for products state.")
+            print(f'{top} could not be read')
+            raise
+        if self.include:
+            print(f'The EVB atoms are in {os.path.relpath(self.include[1])}, only this molecule will be rewritten')
 
-    try:
-        atoms = atom_list(charges, qpdb)
-    except:
-        print('The van der Waals could not be read')
-        sys.exit()
+        # with absolute paths, so that the manifest does not depend on where the outputs are written
+        self.input_files = [os.path.abspath(i) for i in [top, qmatoms] + self.opls + ([self.include[1]] if self.include else [])]
 
-    try:
-        # bonds_x2y contains the bonds that form or break
-        bonds, bonds_x2y = bonds_list(rs, ps, rs_files, ps_files, qpdb, q1, q2, bevb)
-    except:
-        print('The bonds could not be read')
-        sys.exit()
+        # topol.top is read and indexed once, and kept for every write();
+        # with stream, topol.top is only hashed here and it is read again by each write()
+        try:
+            if stream:
+                self.top_sha, self.lines, self.index = file_sha(top), None, None
+            else:
+                self.top_sha, self.lines, self.index = read_topology(top, self.include)
+        except:
+            print(f'{top} could not be read')
+            raise
+
+    def read_qm(self, lines):
+        self.qm_lines = lines
+        self.qm_sha = hashlib.sha256('\n'.join(lines).encode()).hexdigest()
+        (self.qpdb, self.q1, self.q2, self.du, self.charges, self.soft_at, self.bevb, self.bconstr,
+         self.soft_pairs_qm, self.aevb, self.torevb, self.impevb) = read_qm(self.qmatoms, self.rs, self.ps, lines)
+
+    # the same topology with other qmatoms.dat lines, which may change anything but [ atoms ];
+    # topol.top, the .opls files and the 1-4 pairs are shared with this one
+    def variant(self, lines):
+        other = copy.copy(self)
+        other.read_qm(lines)
+        if other.qpdb != self.qpdb:
+            other.common = {}
+        other.built = False
+        return other
+
+    # sha256 of everything that goes into the outputs, for topologies/manifest.dat
+    def input_hashes(self, feps, cutoff, prec, shared, lambdas=None):
+        return input_hashes(self.input_files + [os.path.abspath(__file__)], (feps, cutoff, prec, shared, self.rs, self.ps, lambdas),
+                            {self.input_files[0]: self.top_sha, self.input_files[1]: self.qm_sha})
+
+    def build(self):
+        qpdb, q1, q2, stores = self.qpdb, self.q1, self.q2, self.stores
+        try:
+            self.atoms = atom_list(self.charges, qpdb)
+        except:
+            print('The van der Waals could not be read')
+            raise
 
-    try:
-        # angles_x2y contains the angles that form or break
-        angles, angles_x2y = angles_list(rs, ps, rs_files, ps_files, qpdb, q1, q2, aevb)
-    except:
-        print('No angles were found for this job')
-        #sys.exit()
+        try:
+            # bonds_x2y contains the bonds that form or break
+            self.bonds, bonds_x2y = bonds_list(stores, qpdb, q1, q2, self.bevb)
+        except:
+            print('The bonds could not be read')
+            raise
 
-    try:
-        torsions = torsions_list('torsions', rs, ps, rs_files, ps_files, qpdb, q1, q2, torevb)
-    except:
-        print('No torsions were found for this job')
-    #    #sys.exit()
+        try:
+            # angles_x2y contains the angles that form or break
+            self.angles, angles_x2y = angles_list(stores, qpdb, q1, q2, self.aevb)
+        except:
+            print('No angles were found for this job')
+            self.angles, angles_x2y = [], []
 
-    try:
-        impropers = torsions_list('impropers', rs, ps, rs_files, ps_files, qpdb, q1, q2, impevb)
-    except:
-        print('No impropers were found for this job')
-        #sys.exit()
+        try:
+            self.torsions = torsions_list('torsions', stores, qpdb, q1, q2, self.torevb)
+        except:
+            print('No torsions were found for this job')
+            self.torsions = []
 
-    ## pairs for 1-4 interaction and vdW params
-    pairs_x2y, rs_vdw, ps_vdw = pairs_list(rs, ps, rs_files, ps_files, qpdb, q1, q2)
+        try:
+            self.impropers = torsions_list('impropers', stores, qpdb, q1, q2, self.impevb)
+        except:
+            print('No impropers were found for this job')
+            self.impropers = []
 
-    # bonds and angles present in only one of the states
-    bonds_solo, angles_solo, at_ad = coulomb_list(bonds_x2y, angles_x2y, pairs_x2y, bonds, angles)
+        ## pairs for 1-4 interaction and vdW params; they depend only on [ atoms ], so they are found only once for all the variants
+        if not ('pairs' in self.common):
+            self.common['pairs'] = pairs_list(stores, qpdb, q1, q2)
+        self.pairs_x2y, rs_vdw, ps_vdw = copy.deepcopy(self.common['pairs'])
 
-    # soft core parameters
+        # bonds and angles present in only one of the states
+        bonds_solo, angles_solo, at_ad = coulomb_list(bonds_x2y, angles_x2y, self.pairs_x2y, self.bonds, self.angles)
+
+        # soft core parameters
+        try:
+            self.soft, self.betas = soft_core(at_ad, bonds_solo, angles_solo, self.soft_at, self.soft_pairs_qm)
+        except:
+            print('The soft-core parameters could not be generated')
+            print('Check the input files and try again')
+            raise
+
+        # excluded pairs due to the forming/breaking bonds
+        nb55 = restore_nb(bonds_solo, angles_solo)
+
+        # [ pairs_nb ] and [ pairs ] entries
+        self.nb_list, self.ps_list = pairs_nb(at_ad, self.soft, nb55, bonds_solo, angles_solo, self.pairs_x2y, self.charges, rs_vdw, ps_vdw)
+        self.built = True
+        return self
+
+    # the atoms up to 3 bonds away from region 1, also through the bonds formed in the products state, are
+    # in torsions or 1-4 pairs with it, so they should be in qmatoms.dat as region 2 atoms (see --check-region2)
+    def check_region2(self, bonds_x2y=None):
+        region1 = [int(at) for at in self.du]
+        listed = {int(at) for at in self.charges}
+        if not region1:
+            return []
+        if bonds_x2y is None:
+            bonds_x2y = bonds_list(self.stores, self.qpdb, self.q1, self.q2, self.bevb)[1]
+        # the bond graph of the molecule with the EVB atoms is only built here; with stream, topol.top is read again
+        if self.lines is None:
+            graph = bond_graph(system_bonds(topology_lines(self.input_files[0], self.include), self.include[0] if self.include else 0))
+        else:
+            graph = bond_graph(self.index['bonds'])
+        near = bonded_within(graph, region1, 3, [b[0] for b in bonds_x2y])
+        missing = sorted(at for at in near if at not in listed)
+        if missing:
+            print(f'WARNING! {len(missing)} atoms are up to 3 bonds away from the EVB atoms but are not in qmatoms.dat:')
+            print('   ' + '  '.join(f'{at} ({near[at]})' for at in missing))
+            print('Add them to [atoms] as region 2 atoms if they are in torsions or 1-4 pairs that change')
+        return missing
+
+    # writes outdir/table_b{i}.xvg
+    def write_tables(self, cutoff=1.0, prec='single', previous={}, cache=None, outdir='topologies'):
+        os.makedirs(outdir, exist_ok=True)
+        return gen_tables(self.betas, cutoff, prec, previous, cache, outdir)
+
+    # writes outdir/topol_XXX.top for feps frames, or topol_l<lambda>.top for the given lambdas only, and evbless.top
+    # returns the frames and the other files written, as (file name, size, fingerprint), and the lambdas of the frames
+    def write(self, feps=None, shared=False, jobs=1, previous={}, lambdas=None, outdir='topologies'):
+        if lambdas is None:
+            lambdas = list(np.arange(feps)/(feps-1))
+            names = [f'topol_{i:0>3}.top' for i in range(feps)]
+        else:
+            names = [frame_name(l) for l in lambdas]
+        if self.lines is None:
+            frames, others = stream_top(self.input_files[0], self.atoms, self.bonds, self.angles, self.torsions, self.impropers, self.soft, self.pairs_x2y,
+                                        self.bconstr, self.nb_list, self.ps_list, lambdas, names, shared, self.du, previous, self.include, outdir)
+            return frames, others, lambdas
+        frames, others = write_top(self.lines, self.index, self.atoms, self.bonds, self.angles, self.torsions, self.impropers, self.soft, self.pairs_x2y,
+                                   self.bconstr, self.nb_list, self.ps_list, lambdas, names, shared, jobs, self.du, previous, outdir)
+        return frames, others, lambdas
+
+    def evb_atoms(self):
+        return [EvbAtom(i, at[1], at[0], at[3], at[2]) for i, at in self.atoms.items()]
+
+    def bonded_terms(self):
+        terms = []
+        for kind, terms_list, n in (('bonds', self.bonds, 2), ('angles', self.angles, 3), ('torsions', self.torsions, 4), ('impropers', self.impropers, 4)):
+            for t in terms_list:
+                terms.append(BondedTerm(kind, tuple(t[:n]), int(t[n]), tuple(t[n+1:])))
+        return terms
+
+    def soft_pairs(self):
+        return [SoftPair((s[0], s[1]), s[3], s[4], s[5], s[6], s[7]) for s in self.soft]
+
+    def nb_pairs(self):
+        return [PairNB((p[0], p[1]), p[2], p[3], p[4], p[6]) for p in self.nb_list]
+
+
+### a sweep file gives qmatoms.dat values to be changed, in [ variant ] blocks:
+###   [ beta30 ]
+###   ; section     atoms     column   value(s)
+###   soft-core     13        3        30.0
+###   bonds         13 30     5        400.0  460.0  520.0
+### the column is counted from 1, as in the qmatoms.dat line. The atoms, [ atoms ] excepted, are the
+### first columns of the line to be changed. With more values, the variant gives a grid of all of them
+### (beta30_0, beta30_1, ...), and every variant is written in its own directory, in <sweep file>.d/
+sweep_sections = {'soft-core': 1, 'bonds': 2, 'bcon': 2, 'soft-pairs': 2, 'angles': 3, 'torsions': 4, 'impropers': 4}
+
+# returns [(variant name, qmatoms.dat lines)]
+def read_sweep(sweep, qm_lines):
+    blocks = []
+    with open(sweep) as f:
+        data = f.read().split("\n")
+    for i, l in enumerate(data):
+        if ';' in l:
+            l = l[:l.index(';')]
+        elif '#' in l:
+            l = l[:l.index('#')]
+        line = l.strip().split()
+        try:
+            if not line:
+                continue
+            elif (''.join(line)[0] == '[') and (''.join(line)[-1] == ']'):
+                blocks.append((''.join(line)[1:-1], []))
+            else:
+                n = sweep_sections[line[0]]
+                values = line[n+2:]
+                if (not blocks) or (not values):
+                    raise ValueError
+                blocks[-1][1].append((line[0], line[1:n+1], int(line[n+1]), values))
+        except Exception as err:
+            raise ValueError(f"There is an error in {sweep} file at line {i+1}.") from err
+
+    variants = []
+    for name, changes in blocks:
+        grid = [[]]
+        for change in changes:
+            grid = [g + [(change, value)] for g in grid for value in change[3]]
+        for k, g in enumerate(grid):
+            lines = list(qm_lines)
+            for change, value in g:
+                set_qm_value(lines, change[0], change[1], change[2], value)
+            variants.append((name if len(grid) == 1 else f'{name}_{k}', lines))
+    return variants
+
+# puts value in the column of the line that starts with atoms in [ section ] of qmatoms.dat
+def set_qm_value(lines, section, atoms, column, value):
+    current = None
+    for i, l in enumerate(lines):
+        code = l
+        if ';' in l:
+            code = l[:l.index(';')]
+        elif '#' in l:
+            code = l[:l.index('#')]
+        line = code.strip().split()
+        if not line:
+            continue
+        if ('[' in ''.join(line)) and (']' in ''.join(line)):
+            current = ''.join(line)[1:-1]
+        elif (current == section) and (line[:len(atoms)] == atoms):
+            fields = list(re.finditer(r'\S+', code))
+            if not (len(atoms) < column <= len(fields)):
+                break
+            field = fields[column-1]
+            lines[i] = l[:field.start()] + f'{value:>{len(field.group())}}' + l[field.end():]
+            return
+    raise ValueError(f"Column {column} of {' '.join(atoms)} in [{section}] could not be changed in the qmatoms file")
+
+# name of the topology for a single lambda, e.g. topol_l0.5300.top
+def frame_name(l):
+    return f'topol_l{l:.4f}.top'
+
+# writes outdir: the tables, the topologies and evbless.top, and the manifest
+def generate(topology, feps, cutoff, prec, shared, jobs, force, tables_cache, lambdas=None, outdir='topologies'):
+    # nothing is regenerated if none of the inputs changed since the last run and all the outputs are still there
     try:
-        soft, betas = soft_core(at_ad, bonds_solo, angles_solo, soft_at, soft_pairs)
+        inputs = topology.input_hashes(feps, cutoff, prec, shared, lambdas)
     except:
-        print('The soft-core parameters could not be generated')
-        print('Check the input files and try again')
-        sys.exit()
+        print('The input files could not be read')
+        raise
+    previous_inputs, previous = read_manifest(outdir)
+    if force:
+        previous = {}
+    elif previous and (previous_inputs == inputs) and all(intact(i, previous, outdir) for i in previous):
+        print(f'The inputs did not change since the last run, {outdir}/ is up to date (use --force to rewrite it)')
+        return
+
+    # the messages are printed by build()
+    topology.build()
 
     # generate tabulated tables for soft-core potential
-    gen_tables(betas, cutoff, prec)
-
-    # excluded pairs due to the forming/breaking bonds
-    nb55 = restore_nb(bonds_solo, angles_solo)
+    try:
+        tables = topology.write_tables(cutoff, prec, previous, tables_cache, outdir)
+    except OSError:
+        print('The soft-core tables could not be written')
+        raise
 
-    # write topologies
+    # write topologies and evbless.top
     try:
-        write_top(at_ad,top,atoms,bonds,angles,torsions,impropers,soft,bonds_solo,angles_solo,pairs_x2y,charges,rs_vdw,ps_vdw,feps,bconstr,nb55)
+        frames, others, lambdas = topology.write(feps, shared, jobs, previous, lambdas, outdir)
     except:
         print('Topology files could not be written')
-        sys.exit()
+        raise
+
+    write_manifest(inputs, frames, lambdas, tables + others, previous, outdir)
+
+
+if __name__ == "__main__":
+    feps, qmatoms, top, rs, ps, cutoff, prec, shared, jobs, force, tables_cache, sweep, lambdas, stream, check = get_args()
+    if prec not in ['single', 'double']:
+        sys.exit("Precision can only be 'single' or 'double' (default: single).")
+    if lambdas:
+        if not all(0 <= l <= 1 for l in lambdas):
+            sys.exit("The lambdas must be between 0 and 1.")
+        if len(set(frame_name(l) for l in lambdas)) < len(lambdas):
+            sys.exit("The lambdas must differ in the first 4 decimals.")
+    elif not feps:
+        sys.exit("Give the number of FEP frames (-f) or the lambdas to be written (--lambdas).")
 
-    # write evbless.top
     try:
-        evb_less('topol_000.top', 'evbless.top', du)
-    except:
-        print('evbless.top file could not be written')
+        topology = Topology(top, qmatoms, rs, ps, stream)
+        if check:
+            topology.check_region2()
+
+        if not sweep:
+            generate(topology, feps, cutoff, prec, shared, jobs, force, tables_cache, lambdas)
+        else:
+            # every variant goes in <sweep file>.d/<variant>/, and the variants share the tables with the same beta;
+            # the name keeps the extension of the sweep file, so that it can never be the sweep file itself
+            variants = read_sweep(sweep, topology.qm_lines)
+            root = os.path.abspath(sweep) + '.d'
+            tables_cache = os.path.abspath(tables_cache) if tables_cache else os.path.join(root, 'tables')
+            for name, lines in variants:
+                print(f'--- {name}')
+                os.makedirs(os.path.join(root, name, 'topologies'), exist_ok=True)
+                with open(os.path.join(root, name, os.path.basename(qmatoms)), "w") as f:
+                    f.write('\n'.join(lines))
+                generate(topology.variant(lines), feps, cutoff, prec, shared, jobs, force, tables_cache, lambdas,
+                         os.path.join(root, name, 'topologies'))
+    except Exception as err:
+        sys.exit(f'gmx4evb.py stopped: {err}')
 
     # show citing paper
     '''print("""
 If you find these tools useful, please cite the following paper:
 Gabriel Oanca, Florian van der Ent, Johan Åqvist, Efficient Empirical Valence Bond Simulations with GROMACS, Journal of Chemical Theory and Computation, 2023, doi: 10.1021/acs.jctc.3c00714
 """)'''
-
@@ -7,19 +7,26 @@
 ## use it as: mapping.py -i rep_000.dat -a [alpha] -hij [hij] -t [temp]
 
 import sys, os
+import struct
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import math as m
 import argparse
-import warnings
+import re
 try:
     import matplotlib.pyplot as plt
     pfig = True
 except:
     pfig = False
 
+xvg_legend = re.compile(r'@\s*s(\d+)\s+legend\s+"(.*)"')
+xdr_int = struct.Struct('>i')
+# bytes per item of the edr block data types: int, float, double, int64, char (written as int); strings are read one by one
+xdr_sizes = {0: 4, 1: 4, 2: 8, 3: 8, 4: 4}
+
 
 def get_args():
-    parser = argparse.ArgumentParser(epilog="NOTE: We recommend that you skip the arguments --reactant, --product, and --evbless and let the program select all the energy files from the working directory.")
+    parser = argparse.ArgumentParser(epilog="NOTE: We recommend that you skip the arguments --reactant, --product, and --evbless and let the program select all the energy files from the working directory. The .edr files are used if there are any, otherwise the .xvg files.")
     parser.add_argument("--alpha", help="Gas-phase shift. Default: 0.0", required=False, type=float, default=0.0)
     parser.add_argument("--hij", help="EVB off-diagonal. Default: 0.0", required=False, type=float, default=0.0)
     parser.add_argument("-s", "--skip", help="Number of points to skip. Default: 10%% of all data points", required=False, type=int, default=-1)
@@ -28,10 +35,12 @@ def get_args():
     parser.add_argument("-b", "--bins", help="Number of bins for the reaction coordinate. Default: 100", required=False, type=int, default=100)
     parser.add_argument("-m", "--min", help="Minimum number of points per bin. Default: 10", required=False, type=int, default=10)
     parser.add_argument("-o", "--output", help="Output name. Default: 'profile'.", required=False, type=str, default='profile')
-    parser.add_argument("--reactant", help='List of GROMACS energy files with lambda = 0. Default: all GROMACS energy files in the current directory that contain "sysA" in their name.', action='append', nargs='+', required=False, type=str, default=None)
+    parser.add_argument("--reactant", help='List of GROMACS energy files (.edr, or .xvg from gmx energy) with lambda = 0. Default: all GROMACS energy files in the current directory that contain "sysA" in their name.', action='append', nargs='+', required=False, type=str, default=None)
     parser.add_argument("--product", help='List of GROMACS energy files with lambda = 1. Default: all GROMACS energy files in the current directory that contain "sysB" in their name.', action='append', nargs='+', required=False, type=str, default=None)
     parser.add_argument("--evbless", help='List of GROMACS energy files with EVB atoms as dummy. Default: all GROMACS energy files files in the current directory that contain "evbless" in their name.', action='append', nargs='+', required=False, type=str, default=None)
     parser.add_argument("--path", help='Path to energy files, Default: current directory', required=False, type=str, default='.')
+    parser.add_argument("-j", "--workers", help="Number of threads that read the energy files. Default: number of CPUs + 4, up to 32", required=False, type=int, default=None)
+    parser.add_argument("--term", help='Name of the energy term to map, as in gmx energy. Default: "Potential", or the first column of .xvg files without such term', required=False, type=str, default=None)
     args = parser.parse_args()
 
     kT = 1.987e-3 * args.temp
@@ -47,97 +56,242 @@ def get_args():
         for i in args.evbless[0]:
             evbless.append(i)
 
-    return args.alpha, args.hij, args.skip, args.delta_lambda, kT, args.bins, args.min, rs, ps, evbless, args.path, args.output
+    return args.alpha, args.hij, args.skip, args.delta_lambda, kT, args.bins, args.min, rs, ps, evbless, args.path, args.output, args.term, args.workers
 
 
 def get_files(path, top):
     files = []
 
     flist = os.listdir(path)
-    for f in flist:
-        if (".xvg" in f[-4:]) and (top in f):
-            files.append(f)
+    # the .edr files from the reruns, otherwise the .xvg files from gmx energy
+    for ext in (".edr", ".xvg"):
+        for f in flist:
+            if (ext in f[-4:]) and (top in f):
+                files.append(f)
+        if files:
+            break
 
     files.sort()
 
     return files
 
 
-# read data from Qfep input data files and fill in the FEP 
-def read_data(rsf, psf, evblessf, frames, skip, alpha, hij, dl, path):   
-    for i, file in enumerate(rsf):
-        with open(os.path.join(path, file)) as f:
-            data = f.read().strip().split("\n")
-        
-        if i == 0:
-            if skip < 0:
-                skip = len(data[24:])//10 + 24 # skip 10%
+# skips the header of an .xvg file, every leading line that starts with '#' or '@'
+# returns the legends, that map the terms to the columns, and the first data line
+def xvg_header(f):
+    legends = {}
+    line = f.readline()
+    while line and (not line.strip() or line.lstrip()[0] in '#@'):
+        legend = xvg_legend.match(line)
+        if legend:
+            legends[legend.group(2)] = int(legend.group(1)) + 1 # s0 is column 1, column 0 is the time
+        line = f.readline()
+
+    return legends, line
+
+
+# reads a gmx energy .xvg file and returns the column of the energy term as a float array
+def read_xvg(name, term=None):
+    with open(name) as f:
+        legends, line = xvg_header(f)
+        ncols = len(line.split())
+        data = np.fromstring(line + f.read(), sep=' ')
+
+    if ncols < 2 or data.size % ncols:
+        raise ValueError(f"{name}: the data block is not a table of {ncols} columns")
+    data = data.reshape(-1, ncols)
+
+    if term:
+        col = {k.lower(): v for k, v in legends.items()}.get(term.lower())
+        if col is None:
+            raise ValueError(f"{name}: there is no '{term}' term in the file. Available terms: {', '.join(legends)}")
+    else:
+        col = legends.get('Potential', 1)
+
+    return data[:, col]
+
+
+# XDR string: length, then the characters padded to 4 bytes
+def xdr_string(buf, pos):
+    n, = xdr_int.unpack_from(buf, pos)
+    return buf[pos+4:pos+4+n].decode('ascii'), pos + 4 + (n+3)//4*4
+
+
+# walks the frames of a gmx .edr energy file and returns the file content, the byte offsets of the energy term
+# in the frames and the size of the reals; follows enxio.cpp from GROMACS, file versions 1 to 5, single and double precision
+def edr_frames(name, term=None):
+    with open(name, 'rb') as f:
+        buf = f.read()
+
+    magic, = xdr_int.unpack_from(buf, 0)
+    if magic > 0: # version 1 files start with the number of terms
+        version, nre, pos = 1, magic, 4
+    elif magic == -55555:
+        version, nre = struct.unpack_from('>2i', buf, 4)
+        pos = 12
+    else:
+        raise ValueError(f"{name}: this is not a GROMACS .edr file")
+    if version > 5:
+        raise ValueError(f"{name}: .edr file version {version} is not supported")
+
+    names = []
+    try:
+        for i in range(nre):
+            nm, pos = xdr_string(buf, pos)
+            if version >= 2:
+                unit, pos = xdr_string(buf, pos)
+            names.append(nm)
+    except (struct.error, UnicodeDecodeError):
+        raise ValueError(f"{name}: this is not a GROMACS .edr file")
+
+    if term:
+        col = {k.lower(): i for i, k in enumerate(names)}.get(term.lower())
+        if col is None:
+            raise ValueError(f"{name}: there is no '{term}' term in the file. Available terms: {', '.join(names)}")
+    elif 'Potential' in names:
+        col = names.index('Potential')
+    else:
+        raise ValueError(f"{name}: there is no 'Potential' term in the file, select one with --term")
+
+    # double precision files have no frame magic number right after the first real
+    if version == 1:
+        real = 8 if xdr_int.unpack_from(buf, pos+12)[0] == nre else 4
+    else:
+        real = 8 if xdr_int.unpack_from(buf, pos+4)[0] != -7777777 else 4
+    dtreal = 2 if real == 8 else 1 # blocks of old files hold reals
+
+    # as gmx energy, only the frames that hold energies and were fully written
+    offsets = []
+    try:
+        while pos < len(buf):
+            start = pos
+            pos += real
+            if version == 1:
+                fversion = 1
+                pos += 4 # step
             else:
-                skip = skip + 24
-            N = len(data[skip:])  # no. of energy points per frame
-            # frames, [sysA, sysB, evbless, de, V(l), evb, e1-V(l), e2-V(l)], evb-V(l)
-            feps = np.zeros(shape =(frames,9,N))
-            
-        for j, line in enumerate(data[skip:]):
-            feps[i][0][j] = float(line.split()[1]) / 4.184 # sysA
-        del(data)
-    
-    for i, file in enumerate(psf):
-        with open(os.path.join(path, file)) as f:
-            data = f.read().strip().split("\n")
-        for j, line in enumerate(data[skip:]):
-            feps[i][1][j] = float(line.split()[1]) / 4.184 # sysB
-        del(data)
-            
-    for i, file in enumerate(evblessf):
-        with open(os.path.join(path, file)) as f:
-            data = f.read().strip().split("\n")
-        for j, line in enumerate(data[skip:]):
-            feps[i][2][j] = float(line.split()[1]) / 4.184 # evbless
-        del(data)
-            
-    for i in range(frames):
-        for j in range(N):
-            feps[i][3][j] = (feps[i][0][j] - feps[i][1][j] - alpha) # e1-e2
-            feps[i][4][j] = (1-i*dl)*(feps[i][0][j] - feps[i][2][j]) +\
-                            (i*dl)*(feps[i][1][j] - feps[i][2][j] + alpha) # V(l)
-            
-            feps[i][5][j] = 0.5 * (feps[i][0][j] + feps[i][1][j] - 2*feps[i][2][j] + alpha) -\
-                            0.5 * m.sqrt((feps[i][3][j])**2 + 4 * hij ** 2) # evb
-            
-            feps[i][6][j] = (feps[i][0][j] - feps[i][2][j]) - feps[i][4][j] # e1-V(l)
-            feps[i][7][j] = (feps[i][1][j] - feps[i][2][j] + alpha) - feps[i][4][j] # e2-V(l)
-            feps[i][8][j] = feps[i][5][j] - feps[i][4][j] # evb-V(l)
+                if xdr_int.unpack_from(buf, pos)[0] != -7777777:
+                    raise ValueError(f"{name}: the frame at byte {start} is corrupted")
+                fversion, = xdr_int.unpack_from(buf, pos+4)
+                nsum, = xdr_int.unpack_from(buf, pos+24) # after the time and the step
+                pos += 28 + (8 if fversion >= 3 else 0) + (8 if fversion >= 5 else 0) # nsteps, dt
+            frame_nre, ndisre, nblock = struct.unpack_from('>3i', buf, pos)
+            pos += 12
+
+            # block headers: (type, number of items) per subblock
+            subs = [(dtreal, ndisre)] * 2 if (fversion < 4 and ndisre) else []
+            for b in range(nblock):
+                if fversion < 4:
+                    subs.append((dtreal, xdr_int.unpack_from(buf, pos)[0]))
+                    pos += 4
+                else:
+                    nsub, = xdr_int.unpack_from(buf, pos+4)
+                    subs += list(zip(*[iter(struct.unpack_from(f'>{2*nsub}i', buf, pos+8))]*2))
+                    pos += 8 + 8*nsub
+            pos += 12 # e_size and two reserved ints
+
+            # energies: value, and average and sum if there are sums; version 1 files have an extra real
+            nreal = 4 if version == 1 else (3 if nsum > 0 else 1)
+            offset = pos + col*nreal*real
+            pos += frame_nre*nreal*real
+
+            for tp, nr in subs:
+                if tp == 5:
+                    for i in range(nr):
+                        pos = xdr_string(buf, pos)[1]
+                elif tp in xdr_sizes:
+                    pos += xdr_sizes[tp]*nr
+                else:
+                    raise ValueError(f"{name}: unknown data type in the frame at byte {start}")
+
+            if frame_nre and pos <= len(buf):
+                offsets.append(offset)
+    except struct.error: # the last frame was cut short
+        pass
+
+    return buf, offsets, real
+
+
+# reads a gmx .edr energy file and returns the energy term as a float array, as gmx energy would write it
+# the values of all the frames are read in one go, from the offsets found by edr_frames
+def read_edr(name, term=None):
+    buf, offsets, real = edr_frames(name, term)
+    data = np.frombuffer(buf, dtype=np.uint8)[np.array(offsets, dtype=int)[:, None] + np.arange(real)]
+    return data.view('>f8' if real == 8 else '>f4')[:, 0].astype(float)
+
+
+# energy term from a .edr or a gmx energy .xvg file
+def read_energy(name, term=None):
+    if name[-4:] == '.edr':
+        return read_edr(name, term)
+    return read_xvg(name, term)
+
+
+# read data from Qfep input data files and fill in the FEP 
+def read_data(rsf, psf, evblessf, frames, skip, alpha, hij, dl, path, term=None, workers=None):
+    if not (len(rsf) == len(psf) == len(evblessf) == frames):
+        raise ValueError(f"There are {len(rsf)} sysA, {len(psf)} sysB and {len(evblessf)} evbless files for {frames} frames")
+    if (workers is not None) and (workers < 1):
+        raise ValueError(f"The number of workers must be at least 1, not {workers}")
+    files = [(i, k, os.path.join(path, file)) for k, fs in enumerate((rsf, psf, evblessf)) for i, file in enumerate(fs)]
+
+    # the first file gives the number of points, so that feps is allocated before the other files are read
+    first = read_energy(files[0][2], term)
+    rows = len(first)
+    if skip < 0:
+        skip = rows//10 # skip 10%
+    N = rows - skip  # no. of energy points per frame
+    # frames, [sysA, sysB, evbless, de, V(l), evb, e1-V(l), e2-V(l)], evb-V(l)
+    feps = np.zeros(shape =(frames,9,N))
+
+    # k: 0 sysA, 1 sysB, 2 evbless; kJ/mol to kcal/mol straight into the row of feps
+    # returns the file and its number of points if it does not have as many points as the first one
+    def fill(f, energy=None):
+        i, k, name = f
+        if energy is None:
+            energy = read_energy(name, term)
+        if len(energy) != rows:
+            return f"{os.path.basename(name)} ({len(energy)})"
+        np.divide(energy[skip:], 4.184, out=feps[i][k])
+
+    fill(files[0], first)
+    del(first)
+
+    # the other files are read by a pool of threads, as the latency per file dominates on network file systems;
+    # each file is read and parsed only once, and only the files being read are kept besides feps
+    with ThreadPoolExecutor(workers) as pool:
+        odd = [n for n in pool.map(fill, files[1:]) if n]
+    if odd:
+        raise ValueError(f"The energy files must have the same number of points as {os.path.basename(files[0][2])} ({rows}): {', '.join(odd)}")
+
+    # whole frames at once, lambda is broadcast per frame; same operations, in the same order, as per point
+    l = (np.arange(frames) * dl)[:, None]
+    e1 = feps[:, 0] - feps[:, 2]
+    e2 = feps[:, 1] - feps[:, 2] + alpha
+    feps[:, 3] = feps[:, 0] - feps[:, 1] - alpha # e1-e2
+    feps[:, 4] = (1-l)*e1 + l*e2 # V(l)
+    feps[:, 5] = 0.5 * (feps[:, 0] + feps[:, 1] - 2*feps[:, 2] + alpha) -\
+                 0.5 * np.sqrt(feps[:, 3]**2 + 4 * hij ** 2) # evb
+    feps[:, 6] = e1 - feps[:, 4] # e1-V(l)
+    feps[:, 7] = e2 - feps[:, 4] # e2-V(l)
+    feps[:, 8] = feps[:, 5] - feps[:, 4] # evb-V(l)
+    del(e1, e2)
 
     return feps, N
 
 
+# log(sum(exp(a))) over the last axis; the maximum is taken out first, so the exponentials never overflow
+def logsumexp(a):
+    amax = a.max(axis=-1, keepdims=True)
+    return np.log(np.exp(a - amax).sum(axis=-1)) + amax[..., 0]
+
+
 ## dG(lambda)
 def gofl(feps, frames, N, kT, dl):
-    dgf = [] # G(l) forward
-    dgb = [] # G(l) backward
-    dg_lambda = [0]
-    
-    for i in range(frames-1):  # '-1' because forward and backward
-        with warnings.catch_warnings():
-            warnings.filterwarnings('error')
-            try:
-                dgf.append(-kT * m.log(np.exp(feps[i][3] * dl / kT).sum()) + kT * m.log(N))  # exp(-(e2-e1)*dl/kT) because dl is negative
-            except RuntimeWarning:
-                print(f"Value out of numpy.exp() domain for e1-e2 in frame {i}")
-                sys.exit()
-            except ValueError:
-                print(f"{np.exp(feps[i][3] * dl / kT).sum()} is out of math.log() domain for sum(e1-e2) at RS")
-                sys.exit()
-            try:
-                dgb.append(kT * m.log(np.exp(-feps[i+1][3] * dl / kT).sum()) - kT * m.log(N))
-            except RuntimeWarning:
-                print(f"Value out of numpy.exp() domain for e1-e2 in frame {i+1}")
-                sys.exit()
-            except ValueError:
-                print(f"{np.exp(-feps[i+1][3] * dl / kT).sum()} is out of math.log() domain for sum(e1-e2) at RS")
-                sys.exit()
-        dg_lambda.append(dg_lambda[-1] + 0.5 * (dgf[i] + dgb[i]))
+    # all the windows at once: G(l) forward from frame i to i+1 and backward from i+1 to i
+    dgf = -kT * logsumexp(feps[:frames-1, 3] * dl / kT) + kT * m.log(N)  # exp(-(e2-e1)*dl/kT) because dl is negative
+    dgb = kT * logsumexp(-feps[1:frames, 3] * dl / kT) - kT * m.log(N)
+    dg_lambda = np.concatenate(([0], np.cumsum(0.5 * (dgf + dgb))))
 
     # FEP coordinate (lambda)
     lc = [dl*i for i in range(frames)]
@@ -168,129 +322,59 @@ def gaps(feps, bins):
 
 
 # arrange data per lambda per bin
+# the points of bin nbin in frame are order[offsets[frame][nbin]:offsets[frame][nbin+1]], indices into feps[frame]
 def uofx(feps, bins, x, frames):
-    free_en = []
-    for nbin in range(bins):
-        free_en.append([])
-        for frame in range(frames):
-            free_en[nbin].append([[], [], []]) # e1-V(l), e2-V(l), Eg-V(l)
-    
+    x = np.array(x)
+    xp1 = x + 1
+    order = []
+    offsets = np.zeros(shape=(frames, bins+1), dtype=int)
+
     for frame in range(frames): # run over the two gaps
-        for jj, j in enumerate(feps[frame][3]):
-            for nbin in range(bins-1):
-                if nbin == 0:
-                    if  x[nbin] <= j <= x[nbin+1]:
-                        free_en[nbin][frame][0].append(feps[frame][6][jj]) # e1-V(l)
-                        free_en[nbin][frame][1].append(feps[frame][7][jj]) # e2-V(l)
-                        free_en[nbin][frame][2].append(feps[frame][8][jj]) # eg-V(l)
-                        break
-                else:
-                    if  x[nbin] < j <= x[nbin+1]+1:
-                        free_en[nbin][frame][0].append(feps[frame][6][jj]) # e1-V(l)
-                        free_en[nbin][frame][1].append(feps[frame][7][jj]) # e2-V(l)
-                        free_en[nbin][frame][2].append(feps[frame][8][jj]) # eg-V(l)
-                        break
+        j = feps[frame][3]
+        # bin 0 takes x[0] <= j <= x[1]; the others the first nbin with x[nbin] < j <= x[nbin+1]+1, up to bins-2
+        nbin = np.maximum(np.searchsorted(xp1, j) - 1, 1)
+        nbin[nbin >= np.minimum(np.searchsorted(x, j), bins-1)] = -1
+        if bins > 1:
+            nbin[(x[0] <= j) & (j <= x[1])] = 0
 
-    return free_en
+        # stable, so the points keep their order within a bin; the points out of all bins (-1) are dropped
+        order.append(np.argsort(nbin, kind='stable')[np.count_nonzero(nbin < 0):])
+        offsets[frame][1:] = np.cumsum(np.bincount(nbin[nbin >= 0], minlength=bins))
+        offsets[frame] += offsets[frame-1][-1] if frame else 0
+
+    return np.concatenate(order), offsets
 
 
 # Ga(X) and Gb(x) at Xr and Xp
-def gofx(dg_lambda, free_en, bins, frames, minpts, kT, x, N):
-    de, dga, dgb, dgg = [], [], [], [] # e1-e2(l,X), dGa(l,X), etc
-    totpts = [] # total points per bin
-    dx, g1, g2, gg = [], [], [], [] # e1-e2(X), dGa(X), etc
-    
-    #calculates the avverage per lambda per bin
-    for nbin in range(bins):
-        de.append([])
-        dga.append([])
-        dgb.append([])
-        dgg.append([])
-        totpts.append([])
-        
-        for frame in range(frames):
-            if len(free_en[nbin][frame][0]) >= minpts:
-                e1_sum, e2_sum, gg_sum = 0, 0, 0
-                exp1, exp2, expgg = 0, 0, 0
-                npts = len(free_en[nbin][frame][0])
-                totpts[nbin].append(npts)
-                
-                if not(de[nbin]):
-                    de[nbin].append(x[nbin])
-    
-                for pt in range(npts):
-                    e1_sum = e1_sum + free_en[nbin][frame][0][pt]
-                    e2_sum = e2_sum + free_en[nbin][frame][1][pt]
-                    gg_sum = gg_sum + free_en[nbin][frame][2][pt]
-                    
-                avv1 = e1_sum/npts
-                avv2 = e2_sum/npts
-                avvgg = gg_sum/npts
-                
-                for pt in range(npts):
-                    try:
-                        exp1 = exp1 + m.exp(-(free_en[nbin][frame][0][pt] - avv1) / kT)
-                    except OverflowError:
-                        print(f"{-(free_en[nbin][frame][0][pt] - avv1)} for point {pt} in frame {frame} is out of math.exp() domain")
-                        sys.exit()
-                        
-                    try:
-                        exp2 = exp2 + m.exp(-(free_en[nbin][frame][1][pt] - avv2) / kT)
-                    except OverflowError:
-                        print(f"{-(free_en[nbin][frame][1][pt] - avv2)} for point {pt} in frame {frame} is out of math.exp() domain")
-                        sys.exit()
-                        
-                    try:
-                        expgg = expgg + m.exp(-(free_en[nbin][frame][2][pt] - avvgg) / kT)
-                    except OverflowError:
-                        print(f"{-(free_en[nbin][frame][2][pt] - avvgg)} for point {pt} in frame {frame} is out of math.exp() domain")
-                        sys.exit()
-                        
-                with warnings.catch_warnings():
-                    warnings.filterwarnings('error')
-                    try:
-                        dga[nbin].append(dg_lambda[frame] -kT * m.log(exp1/npts) + avv1)
-                    except RuntimeWarning:
-                        print(f"{exp1/npts} for bin {nbin} in frame {frame} is out of math.log() domain")
-                        sys.exit()
-                        
-                    try:
-                        dgb[nbin].append(dg_lambda[frame] -kT * m.log(exp2/npts) + avv2)
-                    except RuntimeWarning:
-                        print(f"{exp2/npts} for bin {nbin} in frame {frame} is out of math.log() domain")
-                        sys.exit()
-                        
-                    try:
-                        dgg[nbin].append(dg_lambda[frame] -kT * m.log(expgg/npts) + avvgg)
-                    except RuntimeWarning:
-                        print(f"{expgg/npts} for bin {nbin} in frame {frame} is out of math.log() domain")
-                        sys.exit()
-                            
-                del(e1_sum, e2_sum, gg_sum, npts, avv1, avv2, avvgg, exp1, exp2, expgg)
-
-    for nbin in range(bins):
-        if de[nbin]:
-            sum1, sum2, sumgg = 0, 0, 0
-            # I bild a new RC because not all bins have data, so dx may be shorter than x
-            dx.append(de[nbin][0])
-            
-            for frame, val in enumerate(dga[nbin]):
-                sum1 = sum1 + val * totpts[nbin][frame]/sum(totpts[nbin])
-                
-            for frame, val in enumerate(dgb[nbin]):
-                sum2 = sum2 + val * totpts[nbin][frame]/sum(totpts[nbin])
-                
-            for frame, val in enumerate(dgg[nbin]):
-                sumgg = sumgg + val * totpts[nbin][frame]/sum(totpts[nbin])
-                    
-            g1.append(sum1)
-            g2.append(sum2)
-            gg.append(sumgg)
-
-    dx = np.array(dx)
-    g1 = np.array(g1)
-    g2 = np.array(g2)
-    gg = np.array(gg)
+def gofx(dg_lambda, feps, order, offsets, bins, frames, minpts, kT, x, N):
+    # order is sorted by frame and then by bin, so every (frame, bin) group is a contiguous run of points
+    npts = np.diff(offsets, axis=1).ravel()
+    groups = np.flatnonzero(npts) # (frame, bin) groups with data, as frame*bins + nbin
+    starts = offsets[:, :-1].ravel()[groups] - offsets[0][0]
+    npts = npts[groups]
+    group = np.repeat(np.arange(len(groups)), npts)
+    en = feps[np.repeat(np.arange(frames), offsets[:, -1] - offsets[:, 0]), 6:9, order].T # e1-V(l), e2-V(l), Eg-V(l)
+
+    # average per lambda per bin, and dG = G(l) - kT log <exp(-(E - <E>)/kT)> + <E> as a log-sum-exp per group
+    avv = np.array([np.bincount(group, weights=e, minlength=len(groups)) for e in en]) / npts
+    dev = -(en - avv[:, group]) / kT
+    devmax = np.maximum.reduceat(dev, starts, axis=1)
+    lse = np.log(np.add.reduceat(np.exp(dev - devmax[:, group]), starts, axis=1)) + devmax
+    dg = dg_lambda[groups // bins] - kT * (lse - np.log(npts)) + avv
+
+    # average over lambda per bin, weighted by the number of points; frames with less than minpts points are left out
+    used = npts >= max(minpts, 1)
+    totpts = np.zeros(shape=(frames*bins))
+    totpts[groups[used]] = npts[used]
+    totpts = totpts.reshape(frames, bins)
+    dga = np.zeros(shape=(3, frames*bins))
+    dga[:, groups[used]] = dg[:, used]
+    dga = dga.reshape(3, frames, bins)
+
+    # I bild a new RC because not all bins have data, so dx may be shorter than x
+    full = totpts.sum(axis=0) > 0
+    dx = np.array(x[:bins])[full]
+    g1, g2, gg = (dga[:, :, full] * totpts[:, full] / totpts[:, full].sum(axis=0)).sum(axis=1)
 
     ### shift the reaction coordinate in the middle of every bin
     half = (x[1] - x[0])/2
@@ -403,7 +487,14 @@ def savedata(dx, g1, g2, gg, name):
 
 
 if __name__ == "__main__":
-    alpha, hij, skip, dl, kT, bins, minpts, rs, ps, evbless, path, out = get_args()
+    alpha, hij, skip, dl, kT, bins, minpts, rs, ps, evbless, path, out, term, workers = get_args()
+
+    if (workers is not None) and (workers < 1):
+        print()
+        print(f"The number of workers (-j) must be at least 1, not {workers}.")
+        print("For help, type 'mapevb.py -h'")
+        print()
+        sys.exit()
 
     if not rs:
         rs = get_files(path, "sysA")
@@ -436,19 +527,20 @@ if __name__ == "__main__":
         out = out[:-ind-1]
 
     try:
-        feps, N = read_data(rs, ps, evbless, len(rs), skip, alpha, hij, dl, path) # read energy files
-    except:
+        feps, N = read_data(rs, ps, evbless, len(rs), skip, alpha, hij, dl, path, term, workers) # read energy files
+    except Exception as err:
         print()
         print("The energy files could not be read. Please check the files and try again.")
+        print(err)
         print("For help, type 'mapevb.py -h'")
         print()
         sys.exit()
 
     dg_lambda, lc = gofl(feps, len(rs), N, kT, dl) # lambda profile using Zwanzig formula
     x = gaps(feps, bins-1)
-    free_en = uofx(feps, bins, x, len(rs))
+    order, offsets = uofx(feps, bins, x, len(rs))
     # dx is corrected by half bin. RS is shifted to 0.0
-    dx, g1, g2, gg = gofx(dg_lambda, free_en, bins, len(rs), minpts, kT, x, N)
+    dx, g1, g2, gg = gofx(dg_lambda, feps, order, offsets, bins, len(rs), minpts, kT, x, N)
     rst, pst, tst = thermo(dx, gg)
 
     if len(tst) == 0: